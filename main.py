@@ -3,7 +3,7 @@ import json
 import logging
 import os
 import tkinter as tk
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from tkinter import messagebox
 import torch
 from memory_profiler import profile
@@ -29,9 +29,14 @@ from server import FightingAircraftGameServer
 from utils.SocketTcpTools import *
 from utils.cls_airplane import *
 from utils.cls_building import *
+from utils.cls_bullets import update_bullet_group
 from utils.cls_explode import Explode
 from utils.cls_game_data import *
+from utils.GameProtocolTools import COMPRESSION_DICTIONARY, apply_frame_update, decode_message, encode_message
 from utils.cls_game_render import *
+from utils.cls_prediction import PlanePredictor
+from utils.cls_replay import ReplayRecorder
+from utils.cls_spatial_hash import collide_mask_wrapped
 from utils.cls_genetic_algorithm import GeneticAlgorithm
 
 
@@ -150,6 +155,9 @@ class FightingAircraftGame:
         # 游戏网络连接
         # self.onlineNodeEnabled = True
         self.client = TcpClientTools()
+        self.client.compression_dictionary = COMPRESSION_DICTIONARY
+        self.use_binary_protocol = True     # 高频消息是否使用二进制协议发送
+        self.use_compression = True     # 是否请求服务器压缩较大的消息
         # 游戏的用户输入
         self.key_states = {pg.K_UP: False,
                            pg.K_DOWN: False,
@@ -178,8 +186,24 @@ class FightingAircraftGame:
         self.local_physic_time_stamp = 0  # 物理运行的帧率计数
         self.local_render_time_stamp = 0  # 渲染运行的帧率计数
         self.local_sync_time_stamp = 0  # 同步帧的帧数计数
-        self.sync_frames_cache = []  # 从服务器同步的渲染帧缓存数组
-        self.history_frames = []  # 整局游戏的所有运行的历史逻辑帧记录，用于历史记录回放等操作
+        self.sync_frames_cache = deque()  # 从服务器同步的渲染帧缓存队列
+        self.max_catch_up_physic_frames = 90  # 同步帧堆积的时候，每一帧最多快进的逻辑帧数
+        self.use_headless_fast_forward = True  # 快进的时候是否跳过渲染，不重新生成精灵图片和 mask
+        self.fast_forward_threshold = 3  # 缓存的同步帧超过这个数量的时候认为正在快进
+        self.is_fast_forward = False  # 是否正在快进追赶服务器的同步帧
+        self.sync_actions = {}  # 由关键帧和增量帧还原出来的所有玩家的完整操作
+        self.input_state = InputState.NoInput  # 本地最新的输入状态，每个同步帧最多发送一次
+        self.last_sent_input_state = None  # 上一次发送给服务器的输入状态
+        self.last_input_send_time = 0.  # 上一次发送输入状态的时间
+        self.use_prediction = True  # 是否对本地玩家的飞机进行预测执行，输入不需要等待服务器的同步帧就可以看到效果
+        self.plane_predictor = PlanePredictor(max_prediction_frames=15)
+        self.use_replay_recorder = True  # 是否把每一局的同步帧记录到回放文件，用 replay.py 回放
+        self.replay_dir = 'replays'  # 回放文件保存的目录
+        self.replay_recorder = ReplayRecorder(keyframe_interval=150)
+        self.use_state_hash = True  # 每个逻辑帧计算世界状态的滚动哈希，随操作发送给服务器检测不同步
+        self.state_hash_interval = 15  # 每隔多少个逻辑帧发送一次状态哈希
+        self.state_hash = 0  # 目前为止的滚动哈希
+        self.pending_state_hashes = deque()  # 等待发送的 (逻辑帧, 状态哈希)
 
         self.is_game_ready = False  # 游戏是否开始
         self.exit_event = threading.Event()  # 游戏是否结束的退出事件
@@ -196,6 +220,8 @@ class FightingAircraftGame:
         4. 对于房屋，有两个不同的状态：完好和摧毁，需要单独一个list进行渲染
         '''
         self.game_data = GameData()
+        self.use_fixed_point_physics = False  # 定点数物理模式，整数角度和三角函数表，结果不依赖平台，房间内所有客户端必须相同
+        self.game_data.set_fixed_point(self.use_fixed_point_physics)
         # 每次跑两分钟
         # self.game_time_max_stamp = 3600
         self.game_time_max_stamp = 999999
@@ -239,12 +265,22 @@ class FightingAircraftGame:
             "command": CommandType.cmd_login.value,
             "player_id": self.player_id,
             # "plane_name": random.choice(list(self.game_resources.airplane_info_map.keys()))
-            "plane_name": 'Bf110'
+            "plane_name": 'Bf110',
+            "compression": self.use_compression
         }
         # random.choice(list(self.game_resources.airplane_info_map.keys()))
-        self.client.send(json.dumps(data), pack_data=True, data_type=DataType.TypeString)
+        self.send_message(data)
         # self.client.send(json.dumps({'command': CommandType.cmd_none.value}), pack_data=True, data_type=DataType.TypeString)
 
+    def send_message(self, message):
+        """
+        按照客户端的协议设置对消息进行编码并发送给服务器
+        :param message: 消息的 dict
+        :return:
+        """
+        data, data_type = encode_message(message, self.use_binary_protocol)
+        self.client.send(data, pack_data=True, data_type=data_type)
+
 
     def game_over(self):
         print('game over, new game starting...')
@@ -254,7 +290,8 @@ class FightingAircraftGame:
             "player_id": self.player_id
         }
         # random.choice(list(self.game_resources.airplane_info_map.keys()))
-        self.client.send(json.dumps(data), pack_data=True, data_type=DataType.TypeString)
+        self.send_message(data)
+        self.replay_recorder.close()
         # 然后进行优化处理并进行下一轮的游戏训练
         max_score = self.genetic_manager.selection(list(self.game_data.id_plane_mapping.values()))
 
@@ -262,8 +299,11 @@ class FightingAircraftGame:
         # 初始化游戏
         self.init_game(self.main_game)
         self.is_game_ready = False
+        self.is_fast_forward = False
         self.local_physic_time_stamp = 0
         self.local_sync_time_stamp = 0
+        self.state_hash = 0
+        self.pending_state_hashes.clear()
 
     def create_new_game(self, data):
         """
@@ -298,6 +338,8 @@ class FightingAircraftGame:
             self.game_data.reset_game_data()
             self.game_data.id_plane_mapping = id_mapping
             for plane, agent, plane_info in zip(id_mapping.values(), self.genetic_manager.population, planes):
+                # 重置之后是新的 EntityStore，继续使用的飞机需要迁移过去
+                plane.attach_entity_store(self.game_data.entity_store)
                 plane.agent_network = agent
                 plane.durability = 200
                 plane.score = 0
@@ -336,11 +378,11 @@ class FightingAircraftGame:
                 new_plane.set_position(np.array([plane_info['position_x'], plane_info['position_y']]))
                 new_plane.get_air_plane_params().id = plane_info['player_id']
                 # 设置主武器和副武器的贴图资源
-                new_plane.air_plane_sprites.primary_bullet_sprite = get_rect_sprite(
-                    self.game_resources.get_bullet_sprite('bullet' + str(param['mainweapon'] + 1)))
+                new_plane.air_plane_sprites.primary_bullet_sprite = self.game_resources.get_weapon_sprite(
+                    'bullet' + str(param['mainweapon'] + 1))
                 # 注意此处获取的 sprite 应该旋转 90 度
-                new_plane.air_plane_sprites.secondary_bullet_sprite = get_rect_sprite(
-                    self.game_resources.get_bullet_sprite('bullet' + str(param['secondweapon'])))
+                new_plane.air_plane_sprites.secondary_bullet_sprite = self.game_resources.get_weapon_sprite(
+                    'bullet' + str(param['secondweapon']))
                 self.game_data.id_plane_mapping[plane_info['player_id']] = new_plane
                 # if plane_info['player_id'] == self.player_id:
                 #     # 加载飞机
@@ -404,19 +446,55 @@ class FightingAircraftGame:
         # new_building.explode_sprite = explode_sprite
         # self.game_data.add_team_buildings(2, new_building)
 
+        self.prewarm_rotation_cache()
+        if self.use_replay_recorder:
+            self.replay_recorder.start(
+                os.path.join(self.replay_dir, time.strftime('%Y%m%d_%H%M%S') + '.replay'),
+                {'player_id': self.player_id,
+                 'fps_physics': self.fps_physics,
+                 'fps_sync': self.fps_sync,
+                 'use_fixed_point': self.game_data.use_fixed_point,
+                 'start_data': data})
         self.local_physic_time_stamp = 0
+        self.state_hash = 0
+        self.pending_state_hashes.clear()
+        # 新的房间中服务器记录的操作是 NoInput，开局之后的第一个输入状态一定要发送，即使和上一局最后发送的相同
+        self.last_sent_input_state = None
+        self.last_input_send_time = 0.
         # self.local_render_time_stamp = 0
         # 进行游戏必要的同步变量设置
         self.is_game_ready = True
         self.lock.release()
 
+    def prewarm_rotation_cache(self):
+        """
+        开局的时候预先计算本局所有武器和炮管在所有角度下旋转之后的图片，避免开火的时候才计算
+        :return:
+        """
+        weapon_sprites = {}
+        for plane in self.game_data.team1_airplanes + self.game_data.team2_airplanes:
+            for sprite in (plane.air_plane_sprites.primary_bullet_sprite,
+                           plane.air_plane_sprites.secondary_bullet_sprite):
+                if sprite is not None:
+                    weapon_sprites[id(sprite)] = sprite
+        for turret in self.game_data.team1_turrets + self.game_data.team2_turrets:
+            for sprite in (turret.bullet_sprite, turret.cannon_sprite):
+                if sprite is not None:
+                    weapon_sprites[id(sprite)] = sprite
+        for sprite in weapon_sprites.values():
+            rotation_cache.prewarm(sprite)
+        print('rotation cache prewarmed: {}'.format(rotation_cache.report(reset=False)))
+
     def callback_recv(self, cmd, params):
         if cmd == CallbackCommand.RecvData:
-            data = params['data']
-            data = json.loads(data.decode())
+            data = decode_message(params['data'], params['data_type'])
+            if data is None:
+                return
             cmd = CommandType(data['command'])
             if cmd == CommandType.cmd_login_resp:
                 self.player_id = data['player_id']
+                if data.get('compression', False):
+                    self.client.enable_compression(self.client.tcp_socket)
                 # self.room_max_player_number = data['room_max_player_number']
             elif cmd == CommandType.cmd_matching_successful:
                 # self.player_id = data['planes'][0]['player_id']
@@ -459,8 +537,10 @@ class FightingAircraftGame:
                 # self.lock.release()
             elif cmd == CommandType.cmd_frame_update:
                 self.lock.acquire()
+                # 服务器可能只发送发生变化的操作，缓存中的每一帧都保存还原之后的完整操作
+                data['actions'] = dict(apply_frame_update(self.sync_actions, data))
                 self.sync_frames_cache.append(data)
-                self.history_frames.append(data)
+                self.replay_recorder.record_frame(data)
                 self.lock.release()
             elif cmd == CommandType.cmd_matching_state_change:
                 self.room_max_player_number = data['room_max_player_number']
@@ -523,13 +603,6 @@ class FightingAircraftGame:
             # self.player_plane.secondary_fire()
 
         if self.is_game_ready:
-            data = {
-                "command": CommandType.cmd_player_action.value,
-                "match_id": 0,
-                "player_id": self.player_id,
-                "action": input_state.value
-            }
-
             # # 注意同步数据
             self.lock.acquire()
             if (self.key_states[pg.K_SPACE] is True) and (preview_key_states[pg.K_SPACE] is False):
@@ -540,9 +613,33 @@ class FightingAircraftGame:
                     self.player_plane_index = 0
                 self.player_plane = all_valid_plane_list[self.player_plane_index]
 
-            self.client.send(json.dumps(data), pack_data=True, data_type=DataType.TypeString)
+            # 按键事件只更新输入状态，由 send_input_state 合并之后发送
+            self.input_state = input_state
             self.lock.release()
 
+    def send_input_state(self):
+        """
+        把合并之后的输入状态发送给服务器，只有输入状态发生变化或者有等待发送的状态哈希的时候才发送，并且每个同步帧最多发送一次
+        :return:
+        """
+        if self.input_state == self.last_sent_input_state and not self.pending_state_hashes:
+            return
+        now = time.monotonic()
+        if now - self.last_input_send_time < 1 / self.fps_sync:
+            return
+        data = {
+            "command": CommandType.cmd_player_action.value,
+            "match_id": 0,
+            "player_id": self.player_id,
+            "action": self.input_state.value
+        }
+        # 状态哈希附带在操作中发送，每条消息最多一个
+        if self.pending_state_hashes:
+            data['hash_frame'], data['state_hash'] = self.pending_state_hashes.popleft()
+        self.send_message(data)
+        self.last_sent_input_state = self.input_state
+        self.last_input_send_time = now
+
     def update_plane_input_state(self, actions):
         """
         更新飞机的输入状态
@@ -587,7 +684,7 @@ class FightingAircraftGame:
             for bullet in crashed:
                 # --------------------------------
                 # 首先利用精确检测看两者是否真正相交
-                if pygame.sprite.collide_mask(bullet, crashed[bullet][0]) is not None:
+                if collide_mask_wrapped(bullet, crashed[bullet][0], self.map_size) is not None:
                     # 然后尝试给飞机对应的伤害
                     sprite = crashed[bullet][0]
                     bullet.parent.score += 1.5
@@ -601,7 +698,7 @@ class FightingAircraftGame:
             for bullet in crashed:
                 # --------------------------------
                 # 首先利用精确检测看两者是否真正相交
-                if pygame.sprite.collide_mask(bullet, crashed[bullet][0]) is not None:
+                if collide_mask_wrapped(bullet, crashed[bullet][0], self.map_size) is not None:
                     # 然后尝试给飞机对应的伤害
                     sprite = crashed[bullet][0]
                     if bullet.explode(sprite):
@@ -611,6 +708,8 @@ class FightingAircraftGame:
         """
         更新飞机的物理状态
         """
+        # 重建子弹碰撞检测使用的空间哈希
+        self.game_data.rebuild_spatial_hashes(self.map_size)
         # ----------------------------------------------------------------
         # 飞机飞行状态的更新
         for plane in self.game_data.team1_airplanes + self.game_data.team2_airplanes:
@@ -619,9 +718,8 @@ class FightingAircraftGame:
                 self.logger.debug(
                     json.dumps({'physic_frame': self.local_physic_time_stamp, 'input': plane.input_state,
                                 'id': plane.get_air_plane_params().id}))
-            for bullet in plane.bullet_group:
-                bullet.fixed_update(delta_time=delta_time)
-                # ----------------------------------------------------------------
+            update_bullet_group(plane.bullet_group, self.game_data.entity_store, plane.get_map_size(),
+                                delta_time=delta_time)
             # 碰撞检测
             self.check_bullet_collision(plane)
 
@@ -629,8 +727,8 @@ class FightingAircraftGame:
         # 防空炮姿态更新
         for turret in self.game_data.team1_turrets + self.game_data.team2_turrets:
             turret.fixed_update(delta_time=delta_time)
-            for bullet in turret.bullet_group:
-                bullet.fixed_update(delta_time=delta_time)
+            update_bullet_group(turret.bullet_group, self.game_data.entity_store, turret.get_map_size(),
+                                delta_time=delta_time)
             # 碰撞检测
             self.check_bullet_collision(turret)
 
@@ -639,6 +737,26 @@ class FightingAircraftGame:
         for explode in self.game_data.list_explodes:
             explode.fixed_update(delta_time=delta_time)
 
+        # ----------------------------------------------------------------
+        # 世界状态的滚动哈希，用于服务器检测客户端之间的不同步
+        if self.use_state_hash:
+            self.state_hash = self.game_data.get_state_hash(self.state_hash)
+            if self.local_physic_time_stamp % self.state_hash_interval == 0:
+                self.pending_state_hashes.append((self.local_physic_time_stamp, self.state_hash))
+
+    def run_physic_frame(self, actions, delta_time):
+        """
+        使用同步帧中的玩家操作运行一个逻辑帧
+        :param actions: 同步帧中所有玩家的完整操作
+        :param delta_time:
+        :return:
+        """
+        # 先更新飞机的输入状态
+        self.update_plane_input_state(actions)
+        # 物理运算
+        self.update_plane_physics(delta_time=delta_time)
+        self.local_physic_time_stamp += 1
+
     def fixed_update(self):
         """
         运行主游戏逻辑：
@@ -650,6 +768,7 @@ class FightingAircraftGame:
         # time_start = time.time()
         if self.is_game_ready:
             self.lock.acquire()
+            self.send_input_state()
             # 首先要刷新渲染的起始时间
             self.render_frame_idx = 0
             '''
@@ -668,41 +787,43 @@ class FightingAircraftGame:
             '''
             frame_step = self.fps_physics / self.fps_sync
 
-            # 此处处理的是快进环节，可以在数据包堆积的时候快进处理没跟上的同步帧数据
-            for sync_frame in self.sync_frames_cache[:-1]:
+            # 此处处理的是快进环节，可以在数据包堆积的时候快进处理没跟上的同步帧数据，
+            # 每一帧最多快进 max_catch_up_physic_frames 个逻辑帧，剩下的留给之后的帧，避免长时间占用锁导致渲染卡住
+            catch_up_physic_frames = 0
+            while len(self.sync_frames_cache) > 1 and catch_up_physic_frames < self.max_catch_up_physic_frames:
+                sync_frame = self.sync_frames_cache[0]
                 # 如果需要同步用户输入，就同步用户输入
                 sync_2_physic_frame = sync_frame['sync_time_stamp'] * frame_step
                 # if (self.local_physic_time_stamp % frame_step == 0
                 #         and self.local_physic_time_stamp == sync_2_physic_frame):
-                while (sync_frame[
-                           'sync_time_stamp'] - 1) * frame_step < self.local_physic_time_stamp <= sync_2_physic_frame:
-                    # 先更新飞机的输入状态
-                    self.update_plane_input_state(sync_frame['actions'])
-                    # 物理运算
-                    self.update_plane_physics(delta_time=delta_time)
-                    self.local_physic_time_stamp += 1
+                while ((sync_frame['sync_time_stamp'] - 1) * frame_step < self.local_physic_time_stamp <= sync_2_physic_frame
+                       and catch_up_physic_frames < self.max_catch_up_physic_frames):
+                    self.run_physic_frame(sync_frame['actions'], delta_time)
+                    catch_up_physic_frames += 1
+                if self.local_physic_time_stamp <= sync_2_physic_frame and \
+                        self.local_physic_time_stamp > (sync_frame['sync_time_stamp'] - 1) * frame_step:
+                    # 预算用完了，这个同步帧还没有运行完，下一帧继续
+                    break
 
                 # 删除目前已经运行的逻辑帧
                 if self.is_use_logger:
                     self.logger.debug(
                         json.dumps(
                             {'physic_frame': self.local_physic_time_stamp, 'actions': sync_frame['actions']}))
-                self.sync_frames_cache.remove(sync_frame)
+                self.sync_frames_cache.popleft()
                 self.local_sync_time_stamp += 1
                 if self.local_physic_time_stamp > self.game_time_max_stamp:
                     # 游戏结束
                     self.game_over()
                 else:
                     print(f'\r local stamp: {self.local_physic_time_stamp}', end='')
+            # 缓存中还有堆积的同步帧，说明还在追赶服务器
+            self.is_fast_forward = len(self.sync_frames_cache) > self.fast_forward_threshold
 
             # 此处只剩一个同步帧，可以慢慢的运行物理逻辑等待服务器下一个同步帧的到来
             if (len(self.sync_frames_cache) == 1 and
                     self.sync_frames_cache[0]['sync_time_stamp'] * frame_step >= self.local_physic_time_stamp):
-                # 先更新飞机的输入状态
-                self.update_plane_input_state(self.sync_frames_cache[0]['actions'])
-                # 物理运算
-                self.update_plane_physics(delta_time=delta_time)
-                self.local_physic_time_stamp += 1
+                self.run_physic_frame(self.sync_frames_cache[0]['actions'], delta_time)
                 if self.local_physic_time_stamp > self.game_time_max_stamp:
                     # 游戏结束
                     self.game_over()
@@ -712,6 +833,14 @@ class FightingAircraftGame:
                 #     self.sync_frames_cache[0]['sync_time_stamp'],
                 #     self.local_sync_time_stamp,
                 #     self.sync_frames_cache[0]['sync_time_stamp'] - self.local_sync_time_stamp), end='')
+
+            # 权威状态运行完之后，使用本地最新的输入预测本地玩家的飞机
+            if self.use_prediction and self.is_game_ready:
+                authority_input = None
+                if len(self.sync_frames_cache) > 0:
+                    authority_input = self.sync_frames_cache[0]['actions'].get(str(self.player_id), 0)
+                self.plane_predictor.update(self.player_plane, self.local_physic_time_stamp, self.input_state,
+                                            delta_time=delta_time, authority_input=authority_input)
             self.lock.release()
 
         # print(f'\rtime cost: {time.time() - time_start}', end='')
@@ -790,11 +919,24 @@ class FightingAircraftGame:
         render_frame_count = self.fps_render / self.fps_physics
 
         self.lock.acquire()
-        if self.is_game_ready:
+        if self.is_game_ready and self.is_fast_forward and self.use_headless_fast_forward:
+            # 快进追赶服务器的时候不渲染，省掉 get_sprite 中的旋转和 mask 的重新生成，只显示追赶的进度
+            self.screen.fill((255, 255, 255))
+            text = font.render(
+                f"Catching up... {len(self.sync_frames_cache)} sync frames behind",
+                True, (0, 0, 0))
+            text_rect = text.get_rect(center=(self.game_window_size[0] // 2, self.game_window_size[1] // 2))
+            self.screen.blit(text, text_rect.topleft)
+        elif self.is_game_ready:
             # 首先判断程序目前渲染帧数，拒绝提前渲染，不然会出现不必要的抖动
             if self.render_frame_idx < render_frame_count:
                 # self.render_frame_idx += delta_time
                 delta_time = self.render_frame_idx * render_frame_time_diff
+                # 渲染的时候本地玩家的飞机使用预测状态，渲染结束之后恢复权威状态
+                predicted_plane = self.player_plane
+                authority_state = None
+                if self.use_prediction:
+                    authority_state = self.plane_predictor.apply_predicted_state(predicted_plane)
                 pos, dir_v = self.player_plane.move(delta_time=delta_time)
                 if self.player_plane.durability <= 0:
                     all_valid_plane_list = self.game_data.team1_airplanes + self.game_data.team2_airplanes
@@ -897,6 +1039,7 @@ class FightingAircraftGame:
                      self.game_window_size[0] * scale,
                      self.game_window_size[1] * scale), 2)
 
+                self.plane_predictor.restore_authority_state(predicted_plane, authority_state)
                 self.render_frame_idx += 1
         else:
             # 清屏
@@ -0,0 +1,43 @@
+import argparse
+import os
+
+# 回放不需要窗口，使用 SDL 的 dummy 驱动
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame as pg
+
+from main import FightingAircraftGame
+from utils.cls_genetic_algorithm import GeneticAlgorithm
+from utils.cls_replay import ReplayPlayer, ReplayReader
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fighting Aircraft Headless Replay Player')
+    parser.add_argument('replay_file', help='the replay file recorded by the game client')
+    parser.add_argument('--seek', default=0, type=int,
+                        help='run to this sync frame before timing the replay')
+    parser.add_argument('--frames', default=None, type=int,
+                        help='the max sync frames to run after seeking, run to the end by default')
+    parser.add_argument('--print-hashes', action='store_true',
+                        help='print the state hashes, compare them with the desync frame reported by the server')
+
+    args = parser.parse_args()
+
+    pg.init()
+    # 加载图片资源的时候需要设置显示模式
+    pg.display.set_mode((1, 1))
+
+    reader = ReplayReader(args.replay_file)
+    print('replay loaded: {}, {} sync frames, {} planes.'.format(
+        args.replay_file, len(reader), len(reader.header['start_data']['planes'])))
+    game = FightingAircraftGame()
+    game.genetic_manager = GeneticAlgorithm()
+    player = ReplayPlayer(game, reader)
+    player.restart()
+    player.seek(args.seek)
+    result = player.run(max_frames=args.frames)
+    print('sync frames: {}, physic frames: {}, elapsed: {:.2f}s, {:.1f}x real time.'.format(
+        result['sync_frames'], result['physic_frames'], result['elapsed'], result['speed']))
+    if args.print_hashes:
+        for physic_frame, state_hash in sorted(player.state_hashes.items()):
+            print('physic frame {}: {:08x}'.format(physic_frame, state_hash))
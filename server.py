@@ -1,14 +1,18 @@
 import argparse
 import json
+import multiprocessing
 import queue
 import random
+import socket
 import threading
 import time
-import pygame
+from collections import OrderedDict, deque
+from multiprocessing.connection import wait
 
 from utils.SocketTcpTools import *
-from utils.cls_airplane import *
-from utils.cls_game_data import CommandType
+from utils.GameProtocolTools import COMPRESSION_DICTIONARY, CommandType, decode_message, encode_message, \
+    get_changed_actions
+from utils.cls_tick_scheduler import TickScheduler
 
 
 def get_ipv4_address():
@@ -51,194 +55,685 @@ class IDAllocator:
         return self.next_available_id
 
 
+class MatchingQueue:
+    """
+    匹配队列，按照加入的先后顺序保存等待匹配的玩家 id，加入和取消都是 O(1)，
+    人数变化的通知会合并，最多每 notify_interval 秒发送一次
+    """
+    def __init__(self, notify_interval=0.5):
+        self.player_ids = OrderedDict()
+        self.notify_interval = notify_interval
+        self.changed = False                # 上一次通知之后人数是否发生了变化
+        self.last_notify_time = 0.
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    def __contains__(self, player_id):
+        return player_id in self.player_ids
+
+    def __iter__(self):
+        return iter(self.player_ids)
+
+    def qsize(self):
+        return len(self.player_ids)
+
+    def put(self, player_id):
+        self.player_ids[player_id] = None
+        self.changed = True
+
+    def cancel(self, player_id):
+        """
+        取消玩家的匹配
+        :param player_id:
+        :return: 玩家是否在匹配队列中
+        """
+        if self.player_ids.pop(player_id, False) is False:
+            return False
+        self.changed = True
+        return True
+
+    def pop_many(self, count):
+        """
+        按照加入的先后顺序取出 count 个玩家
+        :param count:
+        :return: 玩家 id 的 list
+        """
+        player_ids = [self.player_ids.popitem(last=False)[0] for _ in range(min(count, len(self.player_ids)))]
+        if player_ids:
+            self.changed = True
+        return player_ids
+
+    def need_notify(self, now=None):
+        """
+        判断现在是否需要发送人数变化的通知，返回 True 的时候会记录本次通知的时间
+        :param now: 当前时间，默认为 time.monotonic()
+        :return:
+        """
+        if not self.changed:
+            return False
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_notify_time < self.notify_interval:
+            return False
+        self.changed = False
+        self.last_notify_time = now
+        return True
+
+
+class PipeSender:
+    """
+    在单独的线程中向进程间的管道发送消息，发送 socket 需要序列化并且管道满的时候会阻塞，
+    不能在事件循环线程中或者持有锁的时候直接发送，否则一个卡住的管道会让所有客户端都卡住
+    """
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.messages = queue.Queue()
+        self.send_thread = threading.Thread(target=self.send_loop, daemon=True)
+        self.send_thread.start()
+
+    def send(self, message, on_sent=None):
+        """
+        把消息放入发送队列，不会阻塞
+        :param message:
+        :param on_sent: 消息发送之后在发送线程中调用，例如关闭已经移交出去的 socket
+        :return:
+        """
+        self.messages.put((message, on_sent))
+
+    def send_loop(self):
+        while True:
+            message, on_sent = self.messages.get()
+            try:
+                self.pipe.send(message)
+            except (OSError, EOFError) as e:
+                print('failed to send message to the pipe: {!r}'.format(e))
+            if on_sent is not None:
+                on_sent()
+
+
+class RoomWorkerPool:
+    """
+    房间工作进程池，前端进程负责登录和匹配，匹配成功之后把整个房间的连接移交给房间数最少的工作进程，
+    每个工作进程独立的运行自己房间的帧同步，多个进程可以使用所有的 CPU 核心
+    """
+    def __init__(self, worker_count, max_send_queue_bytes, slow_consumer_policy):
+        self.worker_count = worker_count
+        self.max_send_queue_bytes = max_send_queue_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self.workers = []
+        self.lock = threading.Lock()
+        self.monitor_thread = None
+        self.callback_fun = None        # 处理工作进程发回的消息，在监视线程中调用
+
+    def start(self):
+        for worker_index in range(self.worker_count):
+            parent_pipe, child_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_room_worker,
+                args=(child_pipe, worker_index, self.max_send_queue_bytes, self.slow_consumer_policy),
+                daemon=True)
+            process.start()
+            child_pipe.close()
+            self.workers.append({'process': process, 'pipe': parent_pipe, 'room_numbers': set()})
+        # 所有工作进程都创建之后再启动发送线程
+        for worker in self.workers:
+            worker['sender'] = PipeSender(worker['pipe'])
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+        print('start {} room worker processes...'.format(self.worker_count))
+
+    def assign_room(self, room):
+        """
+        把房间交给当前房间数最少的工作进程，房间内的 socket 会随消息一起传递给工作进程
+        :param room: {'room_number', 'start_data',
+                      'players': [{'player_id', 'plane_name', 'tcp_client', 'pending_data', 'unsent_data'}]}
+        :return: 工作进程的编号
+        """
+        self.lock.acquire()
+        worker_index = min(range(len(self.workers)), key=lambda idx: len(self.workers[idx]['room_numbers']))
+        worker = self.workers[worker_index]
+        worker['room_numbers'].add(room['room_number'])
+        self.lock.release()
+        # 工作进程拿到了连接的副本之后，再关闭前端进程里的连接
+        worker['sender'].send(room, on_sent=lambda: [player['tcp_client'].close() for player in room['players']])
+        print('room[{}] has been assigned to worker {}, worker rooms: {}'.format(
+            room['room_number'], worker_index, [len(worker['room_numbers']) for worker in self.workers]))
+        return worker_index
+
+    def monitor(self):
+        """
+        接收工作进程发回的消息，房间关闭的通知用于负载均衡，所有消息都再交给 callback_fun 处理
+        :return:
+        """
+        pipe_2_worker = {worker['pipe']: worker for worker in self.workers}
+        while pipe_2_worker:
+            for pipe in wait(list(pipe_2_worker.keys())):
+                try:
+                    message = pipe.recv()
+                except EOFError:
+                    del pipe_2_worker[pipe]
+                    continue
+                if message[0] == 'room_closed':
+                    # 房间号由前端进程分配，只需要从发送通知的工作进程中删除
+                    self.lock.acquire()
+                    pipe_2_worker[pipe]['room_numbers'].discard(message[1])
+                    self.lock.release()
+                if self.callback_fun is not None:
+                    self.callback_fun(message)
+
+
+def run_room_worker(room_pipe, worker_index, max_send_queue_bytes, slow_consumer_policy):
+    """
+    工作进程的入口，不监听端口，只处理前端进程移交过来的房间
+    :param room_pipe: 和前端进程通信的管道
+    :param worker_index:
+    :param max_send_queue_bytes:
+    :param slow_consumer_policy:
+    :return:
+    """
+    game_server = FightingAircraftGameServer(max_send_queue_bytes=max_send_queue_bytes,
+                                             slow_consumer_policy=slow_consumer_policy,
+                                             listen=False)
+    game_server.room_pipe = room_pipe
+    game_server.room_pipe_sender = PipeSender(room_pipe)
+    print('room worker {} started, pid: {}'.format(worker_index, multiprocessing.current_process().pid))
+    threading.Thread(target=game_server.receive_rooms, daemon=True).start()
+    game_server.server_start()
+
+
 class FightingAircraftGameServer:
-    def __init__(self):
+    def __init__(self, io_mode='selector', max_send_queue_bytes=1024 * 1024,
+                 slow_consumer_policy=SlowConsumerPolicy.Disconnect, worker_count=0, listen=True):
+        """
+        :param io_mode: 网络模型，selector 表示单线程事件循环复用所有连接，thread 表示每个客户端一个线程
+        :param max_send_queue_bytes: selector 模式下每个客户端发送队列的上限
+        :param slow_consumer_policy: selector 模式下发送队列超过上限之后的处理策略
+        :param worker_count: 房间工作进程的数量，大于 0 的时候当前进程只负责匹配，房间交给工作进程运行
+        :param listen: 是否监听端口，工作进程不监听端口，只接管前端进程移交的连接
+        """
+        if (worker_count > 0 or not listen) and io_mode != 'selector':
+            raise ValueError('room workers are only supported in selector io mode')
         self.room_max_player_number = 1
         self.room_info_map = {}                 # 房间和玩家 id 的 map
-        self.matching_queue = queue.Queue()     # 所有目前正在匹配队列等待的玩家 id
+        self.matching_queue = MatchingQueue()   # 所有目前正在匹配队列等待的玩家 id
         self.player_id_2_player_info = {}       # 从 id 到玩家其他信息的 map
         self.tcp_client_2_player_id = {}        # 从 tcp 连接到玩家 id 的 map
-        self.server = TcpSererTools(get_ipv4_address(), port=4444)
-        self.server.start()
+        self.room_worker_pool = None
+        if worker_count > 0:
+            # 在监听端口之前创建工作进程，避免工作进程继承监听 socket
+            self.room_worker_pool = RoomWorkerPool(worker_count, max_send_queue_bytes, slow_consumer_policy)
+            self.room_worker_pool.callback_fun = self.room_worker_callback
+            self.room_worker_pool.start()
+        if io_mode == 'thread':
+            self.server = TcpSererTools(get_ipv4_address(), port=4444)
+        else:
+            self.server = TcpSelectorServerTools(get_ipv4_address(), port=4444,
+                                                 max_send_queue_bytes=max_send_queue_bytes,
+                                                 slow_consumer_policy=slow_consumer_policy)
+        self.server.compression_dictionary = COMPRESSION_DICTIONARY
+        if io_mode == 'thread':
+            self.server.start()
+        else:
+            self.server.start(listen=listen)
         self.server.set_callback_fun(self.server_callback)
-        self.clock = pygame.time.Clock()
+        self.tick_scheduler = TickScheduler(tick_rate=10)
+        self.tick_report_interval = 10          # 每隔多少秒检查一次错过的截止时间
         self.player_id_allocator = IDAllocator()
         self.room_id_allocator = IDAllocator()
         self.time_stamp = 0
+        self.use_binary_protocol = True         # 高频消息是否使用二进制协议发送
+        self.use_delta_frame_update = True      # frame_update 是否只发送发生变化的玩家操作
+        self.keyframe_interval = 30             # 每隔多少帧发送一次包含所有玩家操作的关键帧
+        self.use_compression = True             # 是否允许和客户端协商压缩较大的消息
+        self.max_pending_state_hashes = 64      # 每个房间最多保存多少个还没有收齐的状态哈希
         # self.update_frame_data = {"command": CommandType.cmd_frame_update.value,
         #                           'time_stamp': self.time_stamp,
         #                           "actions": []}
         self.lock = threading.Lock()
+        self.room_pipe = None                   # 工作进程和前端进程通信的管道
+        self.room_pipe_sender = None            # 工作进程向前端进程发送消息，不会阻塞
 
         # self.server_start()
 
+    def hand_off_room(self, room_number, room_player_ids, start_data):
+        """
+        把匹配成功的房间移交给工作进程，前端进程不再管理这些连接，调用前需要持有 self.lock
+        :param room_number:
+        :param room_player_ids:
+        :param start_data: 匹配成功的消息，由工作进程接管连接之后发送
+        :return:
+        """
+        room = {'room_number': room_number, 'start_data': start_data, 'players': []}
+        for player_id in room_player_ids:
+            info = self.player_id_2_player_info.pop(player_id)
+            tcp_client = info['tcp_client']
+            del self.tcp_client_2_player_id[tcp_client]
+            detached = self.server.detach_client(tcp_client)
+            if detached is None:
+                # 移交之前连接已经断开了
+                continue
+            pending_data, unsent_data = detached
+            room['players'].append({'player_id': player_id,
+                                    'plane_name': info['plane_name'],
+                                    'compression': info['compression'],
+                                    'tcp_client': tcp_client,
+                                    'pending_data': pending_data,
+                                    'unsent_data': unsent_data})
+        # 发送是异步的，发送完成之后才会关闭前端进程里的连接
+        self.room_worker_pool.assign_room(room)
+
+    def receive_rooms(self):
+        """
+        工作进程接收前端进程移交过来的房间
+        :return:
+        """
+        while True:
+            try:
+                room = self.room_pipe.recv()
+            except EOFError:
+                print('the front server has exited. ')
+                break
+            self.adopt_room(room)
+
+    def adopt_room(self, room):
+        """
+        工作进程接管房间内所有玩家的连接，并发送匹配成功的消息
+        :param room:
+        :return:
+        """
+        self.lock.acquire()
+        room_number = room['room_number']
+        room_player_tcp_list = []
+        pending_frames = []
+        for player in room['players']:
+            tcp_client = player['tcp_client']
+            self.tcp_client_2_player_id[tcp_client] = player['player_id']
+            self.player_id_2_player_info[player['player_id']] = \
+                {'tcp_client': tcp_client, 'plane_name': player['plane_name'],
+                 'compression': player['compression'], 'room_number': room_number}
+            room_player_tcp_list.append(tcp_client)
+            frames = self.server.adopt_client(tcp_client, player['pending_data'], player['unsent_data'])
+            pending_frames.append((frames, tcp_client))
+            if player['compression']:
+                self.server.enable_compression(tcp_client)
+        self.room_info_map[room_number] = {'tcp_list': room_player_tcp_list,
+                                           'sync_time_stamp': 0,
+                                           'actions': {},
+                                           'input_buffer': deque(),
+                                           'last_sent_actions': {},
+                                           'state_hashes': {},
+                                           'desync_frame': None}
+        self.tick_scheduler.add_room(room_number)
+        self.broadcast_message(room_player_tcp_list, room['start_data'])
+        self.lock.release()
+        # 移交的时候已经接收完整的数据帧，在释放锁之后处理
+        for frames, tcp_client in pending_frames:
+            self.server.process_client_frames(frames, tcp_client)
+
+    def notify_matching_state(self):
+        """
+        通知所有在匹配队列中等待的玩家目前的人数，调用前需要持有 self.lock
+        :return:
+        """
+        start_data = {"command": CommandType.cmd_matching_state_change.value,
+                      'room_max_player_number': self.room_max_player_number,
+                      "queue_current_players": self.matching_queue.qsize()}
+        self.broadcast_message(
+            [self.player_id_2_player_info[player_id]['tcp_client'] for player_id in self.matching_queue],
+            start_data, coalesce_key=CommandType.cmd_matching_state_change)
+
+    def remove_room(self, room_number):
+        """
+        删除房间，工作进程还需要通知前端进程
+        :param room_number:
+        :return:
+        """
+        del self.room_info_map[room_number]
+        self.tick_scheduler.remove_room(room_number)
+        print('the number of room[{}] has been removed, room remaining: {}.'.format(
+            room_number, len(list(self.room_info_map.keys()))))
+        if self.room_pipe_sender is not None:
+            self.room_pipe_sender.send(('room_closed', room_number))
+
+    def send_message(self, tcp_client, message):
+        """
+        按照服务器的协议设置对消息进行编码并发送
+        :param tcp_client:
+        :param message: 消息的 dict
+        :return:
+        """
+        data, data_type = encode_message(message, self.use_binary_protocol)
+        self.server.send(tcp_client, data=data, pack_data=True, data_type=data_type)
+
+    def broadcast_message(self, tcp_clients, message, coalesce_key=None):
+        """
+        向多个客户端发送同一条消息，消息只编码和打包一次
+        :param tcp_clients:
+        :param message: 消息的 dict
+        :param coalesce_key: 只有最新一条有意义的消息（例如匹配人数）设置，客户端发送缓慢时旧的消息可以被丢弃或者合并，
+            帧同步的 frame_update 每一帧都必须送达，不能设置
+        :return:
+        """
+        data, data_type = encode_message(message, self.use_binary_protocol)
+        self.server.broadcast(tcp_clients, data=data, pack_data=True, data_type=data_type,
+                              coalesce_key=coalesce_key)
+
+    def buffer_player_action(self, data):
+        """
+        把玩家的操作放入所在房间的输入缓存，不需要持有 self.lock，
+        dict 的读取和 deque 的 append 都是原子操作，缓存在 server_start 中每一帧合并一次
+        :param data: 解码后的 cmd_player_action
+        :return:
+        """
+        player_info = self.player_id_2_player_info.get(data['player_id'])
+        if player_info is None or 'room_number' not in player_info:
+            return
+        room_info = self.room_info_map.get(player_info['room_number'])
+        if room_info is None:
+            return
+        room_info['input_buffer'].append((data['player_id'], data['action']))
+        if 'state_hash' in data:
+            self.check_state_hash(room_info, data['player_id'], data['hash_frame'], data['state_hash'])
+
+    def check_state_hash(self, room_info, player_id, hash_frame, state_hash):
+        """
+        比较房间内所有玩家同一个逻辑帧的状态哈希，出现不同的时候记录最早的不同步的逻辑帧，
+        状态哈希发送的频率很低，这里可以获取 self.lock
+        :param room_info:
+        :param player_id:
+        :param hash_frame: 计算哈希的逻辑帧
+        :param state_hash:
+        :return: 目前收到的这一帧的哈希是否一致
+        """
+        self.lock.acquire()
+        state_hashes = room_info['state_hashes']
+        frame_hashes = state_hashes.setdefault(hash_frame, {})
+        frame_hashes[player_id] = state_hash
+        is_same = len(set(frame_hashes.values())) == 1
+        if not is_same and (room_info['desync_frame'] is None or hash_frame < room_info['desync_frame']):
+            room_info['desync_frame'] = hash_frame
+            print('desync detected at physic frame {}, state hashes: {}'.format(hash_frame, frame_hashes))
+        # 所有玩家的哈希都收到之后就不再需要保存
+        if len(frame_hashes) >= len(room_info['tcp_list']):
+            del state_hashes[hash_frame]
+        while len(state_hashes) > self.max_pending_state_hashes:
+            del state_hashes[min(state_hashes)]
+        self.lock.release()
+        return is_same
+
+    def drain_input_buffer(self, room_info):
+        """
+        合并房间输入缓存中的所有操作，同一个玩家只保留最后一次的操作，调用前需要持有 self.lock
+        :param room_info:
+        :return: 合并的操作数量
+        """
+        input_buffer = room_info['input_buffer']
+        actions = room_info['actions']
+        # 只取出当前已经在缓存中的操作，之后写入的操作留到下一帧
+        input_count = len(input_buffer)
+        for _ in range(input_count):
+            player_id, action = input_buffer.popleft()
+            actions[player_id] = action
+        return input_count
+
+    def handle_login(self, tcp_client, data):
+        """
+        分配玩家 id 并加入匹配队列，人数足够的时候创建房间，调用前需要持有 self.lock
+        :param tcp_client:
+        :param data: 解码后的 cmd_login
+        :return:
+        """
+        data_resp = {}
+        data_resp['command'] = CommandType.cmd_login_resp.value
+        new_player_id = self.player_id_allocator.allocate_id()
+
+        # 保存玩家和对应的发送端口
+        data_resp['player_id'] = new_player_id
+        # data_resp['room_max_player_number'] = self.room_max_player_number
+        # 客户端支持压缩的时候，之后发送给它的较大的消息都会压缩
+        data_resp['compression'] = self.use_compression and data.get('compression', False)
+        self.tcp_client_2_player_id[tcp_client] = new_player_id
+        self.player_id_2_player_info[new_player_id] = \
+            {'tcp_client': tcp_client, 'plane_name': data['plane_name'],
+             'compression': data_resp['compression']}
+        self.matching_queue.put(new_player_id)
+        self.send_message(tcp_client, data_resp)
+        if data_resp['compression']:
+            self.server.enable_compression(tcp_client)
+        # self.server.send(server.tcp_clients[0], data=json.dumps(data_resp), pack_data=True, data_type=DataType.TypeString)
+
+        if self.matching_queue.qsize() >= self.room_max_player_number:
+            start_data = {"command": CommandType.cmd_matching_successful.value,
+                          'sync_time_stamp': 0,
+                          'map_id': int(random.random() * 36 + 1),
+                          "planes": []}
+            # 准备好所有待发送数据
+            room_number = self.room_id_allocator.allocate_id()
+            room_player_tcp_list = []
+            room_player_ids = []
+            for player_id in self.matching_queue.pop_many(self.room_max_player_number):
+                room_player_ids.append(player_id)
+                info = self.player_id_2_player_info[player_id]
+                # 此处引用传递，已经将 self.player_id_2_player_info[player_id] 内容修改了
+                info['room_number'] = room_number
+                room_player_tcp_list.append(
+                    self.player_id_2_player_info[player_id]['tcp_client'])
+                start_data["planes"].append(
+                    {"player_id": player_id,
+                     # "position_x": random.random() * 5000,
+                     # "position_y": random.random() * 5000,
+                     # 'plane_name': info['plane_name']
+                     "position_x": 2000,
+                     "position_y": 2000,
+                     'plane_name': info['plane_name']
+                     })
+
+            if self.room_worker_pool is not None:
+                # 分片模式下房间交给工作进程运行，由工作进程发送匹配成功的消息
+                self.hand_off_room(room_number, room_player_ids, start_data)
+            else:
+                self.room_info_map[room_number] = {'tcp_list': room_player_tcp_list,
+                                                   'sync_time_stamp': 0,
+                                                   'actions': {},
+                                                   'input_buffer': deque(),
+                                                   'last_sent_actions': {},
+                                                   'state_hashes': {},
+                                                   'desync_frame': None}
+                self.tick_scheduler.add_room(room_number)
+                # 给所有的匹配成功的客户端发送消息
+                self.broadcast_message(room_player_tcp_list, start_data)
+        # 匹配队列人数变化的通知在 server_start 中合并发送
+
+    def return_client(self, tcp_client, data):
+        """
+        工作进程中的玩家重新登录，把连接交还给前端进程，由前端进程统一分配玩家 id 和房间，调用前需要持有 self.lock
+        :param tcp_client:
+        :param data: 解码后的 cmd_login，交给前端进程处理
+        :return:
+        """
+        player_id = self.tcp_client_2_player_id.pop(tcp_client, None)
+        if player_id is not None:
+            info = self.player_id_2_player_info.pop(player_id, None)
+            room_number = info.get('room_number') if info is not None else None
+            room_info = self.room_info_map.get(room_number)
+            if room_info is not None and tcp_client in room_info['tcp_list']:
+                room_info['tcp_list'].remove(tcp_client)
+                if not room_info['tcp_list']:
+                    self.remove_room(room_number)
+        detached = self.server.detach_client(tcp_client)
+        if detached is None:
+            return
+        pending_data, unsent_data = detached
+        client = {'player_id': player_id, 'tcp_client': tcp_client, 'login': data,
+                  'pending_data': pending_data, 'unsent_data': unsent_data}
+        # 前端进程拿到连接的副本之后再关闭工作进程里的连接
+        self.room_pipe_sender.send(('client_returned', client), on_sent=tcp_client.close)
+
+    def room_worker_callback(self, message):
+        """
+        前端进程接收工作进程发回的消息，在 RoomWorkerPool 的监视线程中调用，交给事件循环线程处理
+        :param message:
+        :return:
+        """
+        self.server.call_soon(lambda: self.handle_worker_message(message))
+
+    def handle_worker_message(self, message):
+        """
+        在事件循环线程中处理工作进程发回的消息：
+        房间关闭的时候回收房间号，玩家离开工作进程的时候回收玩家 id，重新登录的连接由前端进程接管并重新匹配
+        :param message: ('room_closed', room_number) | ('player_left', player_id) | ('client_returned', client)
+        :return:
+        """
+        frames = []
+        self.lock.acquire()
+        try:
+            if message[0] == 'room_closed':
+                self.room_id_allocator.release_id(message[1])
+            elif message[0] == 'player_left':
+                self.player_id_allocator.release_id(message[1])
+            elif message[0] == 'client_returned':
+                client = message[1]
+                if client['player_id'] is not None:
+                    self.player_id_allocator.release_id(client['player_id'])
+                frames = self.server.adopt_client(client['tcp_client'], client['pending_data'],
+                                                  client['unsent_data'])
+                self.handle_login(client['tcp_client'], client['login'])
+        finally:
+            self.lock.release()
+        if frames:
+            self.server.process_client_frames(frames, message[1]['tcp_client'])
+
     def server_callback(self, cmd, param):
         """
         服务器的处理函数
         :param data:
         :return:
         """
-        self.lock.acquire()
         if cmd == CallbackCommand.RecvData:
-            data = param['data']
-            tcp_client = param['tcp_client']
-
-            data = json.loads(data.decode())
-            cmd = CommandType(data['command'])
-            data_resp = {}
-            if cmd == CommandType.cmd_login:
-                data_resp['command'] = CommandType.cmd_login_resp.value
-                new_player_id = self.player_id_allocator.allocate_id()
-
-                # 保存玩家和对应的发送端口
-                data_resp['player_id'] = new_player_id
-                # data_resp['room_max_player_number'] = self.room_max_player_number
-                self.tcp_client_2_player_id[tcp_client] = new_player_id
-                self.player_id_2_player_info[new_player_id] = \
-                    {'tcp_client': tcp_client, 'plane_name': data['plane_name']}
-                self.matching_queue.put(new_player_id)
-                self.server.send(tcp_client, data=json.dumps(data_resp),
-                                 pack_data=True, data_type=DataType.TypeString)
-                # self.server.send(server.tcp_clients[0], data=json.dumps(data_resp), pack_data=True, data_type=DataType.TypeString)
-
-                if self.matching_queue.qsize() >= self.room_max_player_number:
-                    start_data = {"command": CommandType.cmd_matching_successful.value,
-                                  'sync_time_stamp': 0,
-                                  'map_id': int(random.random() * 36 + 1),
-                                  "planes": []}
-                    # 准备好所有待发送数据
-                    room_number = self.room_id_allocator.allocate_id()
-                    room_player_tcp_list = []
-                    for idx in range(self.room_max_player_number):
-                        player_id = self.matching_queue.get()
-                        info = self.player_id_2_player_info[player_id]
-                        # 此处引用传递，已经将 self.player_id_2_player_info[player_id] 内容修改了
-                        info['room_number'] = room_number
-                        room_player_tcp_list.append(
-                            self.player_id_2_player_info[player_id]['tcp_client'])
-                        start_data["planes"].append(
-                            {"player_id": player_id,
-                             # "position_x": random.random() * 5000,
-                             # "position_y": random.random() * 5000,
-                             # 'plane_name': info['plane_name']
-                             "position_x": 2000,
-                             "position_y": 2000,
-                             'plane_name': info['plane_name']
-                             })
-
-                    self.room_info_map[room_number] = {'tcp_list': room_player_tcp_list,
-                                                       'sync_time_stamp': 0,
-                                                       'actions': {}}
-                    # 给所有的匹配成功的客户端发送消息
-                    for client in room_player_tcp_list:
-                        self.server.send(
-                            tcp_socket=client,
-                            data=json.dumps(start_data),
-                            pack_data=True,
-                            data_type=DataType.TypeString)
-                else:
-                    # 此处需要通知其他在匹配队列的玩家目前人数更新
-                    start_data = {"command": CommandType.cmd_matching_state_change.value,
-                                  'room_max_player_number': self.room_max_player_number,
-                                  "queue_current_players": self.matching_queue.qsize()}
-                    # 给每一个等待的玩家实时通知此时的匹配消息
-                    for player_id in self.matching_queue.queue:
-                        self.server.send(
-                            self.player_id_2_player_info[player_id]['tcp_client'],
-                            data=json.dumps(start_data),
-                            pack_data=True,
-                            data_type=DataType.TypeString)
-
-            elif cmd == CommandType.cmd_player_action:
-                player_id = data['player_id']
-                room_number = self.player_id_2_player_info[player_id]['room_number']
-                actions = self.room_info_map[room_number]['actions']
-                actions[player_id] = data['action']
-            elif cmd == CommandType.cmd_game_over:
-                data = param['data']
-
-                data = json.loads(data.decode())
-                player_id = data['player_id']
-                # 首先找到房间号
-                room_number = self.player_id_2_player_info[player_id]['room_number']
-                # 删除房间
-                del self.room_info_map[room_number]
-                print('the number of room[{}] has been removed, room remaining: {}.'.format(
-                    room_number, len(list(self.room_info_map.keys()))))
-            else:
-                print(data)
-        elif cmd == CallbackCommand.SocketClose:
-            tcp_client = param
-            player_id = self.tcp_client_2_player_id[tcp_client]
-            # 首先需要判断它是否仍在匹配队列
-            if player_id in self.matching_queue.queue:
-                self.matching_queue.queue.remove(player_id)
-                # 此处需要通知其他在匹配队列的玩家目前人数更新
-                start_data = {"command": CommandType.cmd_matching_state_change.value,
-                              'room_max_player_number': self.room_max_player_number,
-                              "queue_current_players": self.matching_queue.qsize()}
-                # 给每一个等待的玩家实时通知此时的匹配消息
-                for player_id in self.matching_queue.queue:
-                    self.server.send(
-                        self.player_id_2_player_info[player_id]['tcp_client'],
-                        data=json.dumps(start_data),
-                        pack_data=True,
-                        data_type=DataType.TypeString)
-            else:
-                if player_id in self.player_id_2_player_info:
+            data = decode_message(param['data'], param['data_type'])
+            if data is None:
+                return
+            # 玩家操作是最频繁的消息，不需要获取 self.lock，直接写入房间的输入缓存
+            if data['command'] == CommandType.cmd_player_action.value:
+                self.buffer_player_action(data)
+                return
+
+        self.lock.acquire()
+        # 处理出现异常的时候也要释放线程锁，否则所有客户端都会卡住
+        try:
+            if cmd == CallbackCommand.RecvData:
+                tcp_client = param['tcp_client']
+                cmd = CommandType(data['command'])
+                if cmd == CommandType.cmd_login:
+                    if self.room_pipe_sender is not None:
+                        # 工作进程不分配玩家 id 也不进行匹配，重新登录的连接交还给前端进程
+                        self.return_client(tcp_client, data)
+                    else:
+                        self.handle_login(tcp_client, data)
+
+                elif cmd == CommandType.cmd_game_over:
+                    player_id = data['player_id']
+                    # 首先找到房间号
                     room_number = self.player_id_2_player_info[player_id]['room_number']
-                    # 首先判断他在哪个房间，如果房间没人了，直接把房间删了，否则就发送通知，某玩家离线
-                    room_info = self.room_info_map[room_number]
-                    room_info['tcp_list'].remove(tcp_client)
-                    player_left_number = len(room_info['tcp_list'])
-                    print('player_id: {} has offline, the room_number: {} has left {} players.'.format(
-                        player_id, room_number, player_left_number))
-                    if player_left_number == 0:
-                        del self.room_info_map[room_number]
-                        print('the number of room[{}] has been removed, room remaining: {}.'.format(
-                            room_number, len(list(self.room_info_map.keys()))))
-
-                    # 删除这两个用户
+                    # 删除房间
+                    self.remove_room(room_number)
+                else:
+                    print(data)
+            elif cmd == CallbackCommand.SocketClose:
+                tcp_client = param
+                # 还没有登录就断开的连接没有对应的玩家
+                player_id = self.tcp_client_2_player_id.get(tcp_client)
+                if player_id is None:
+                    return
+                # 首先需要判断它是否仍在匹配队列，人数变化的通知在 server_start 中合并发送
+                if self.matching_queue.cancel(player_id):
                     del self.player_id_2_player_info[player_id]
-
-                del self.tcp_client_2_player_id[tcp_client]
-
-        # 释放线程锁
-        self.lock.release()
+                    del self.tcp_client_2_player_id[tcp_client]
+                else:
+                    if player_id in self.player_id_2_player_info:
+                        room_number = self.player_id_2_player_info[player_id]['room_number']
+                        # 首先判断他在哪个房间，如果房间没人了，直接把房间删了，否则就发送通知，某玩家离线
+                        # 游戏结束的时候房间已经被删除了
+                        room_info = self.room_info_map.get(room_number)
+                        if room_info is not None:
+                            room_info['tcp_list'].remove(tcp_client)
+                            player_left_number = len(room_info['tcp_list'])
+                            print('player_id: {} has offline, the room_number: {} has left {} players.'.format(
+                                player_id, room_number, player_left_number))
+                            if player_left_number == 0:
+                                self.remove_room(room_number)
+
+                        # 删除这两个用户
+                        del self.player_id_2_player_info[player_id]
+
+                    del self.tcp_client_2_player_id[tcp_client]
+                    # 工作进程中的玩家离开之后，由前端进程回收玩家 id
+                    if self.room_pipe_sender is not None:
+                        self.room_pipe_sender.send(('player_left', player_id))
+        finally:
+            # 释放线程锁
+            self.lock.release()
 
     def server_start(self):
         frame_update_template = {'command': CommandType.cmd_frame_update.value,
                                  'actions': {},
+                                 'is_keyframe': True,
                                  'sync_time_stamp': 0}
 
-        print('server tick 10FPS!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
+        print('server tick {}FPS!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!'.format(self.tick_scheduler.tick_rate))
+        last_report_time = time.monotonic()
         while True:
-            old_time = time.time()
             self.lock.acquire()
-            # 此处的逻辑是一个房间一个房间的发
-            for key in list(self.room_info_map.keys()):
-                room_info = self.room_info_map[key]
-                frame_update_template['actions'] = room_info['actions']
-                frame_update_template['sync_time_stamp'] = room_info['sync_time_stamp']
-                for client in room_info['tcp_list']:
-                    self.server.send(client,
-                                     data=json.dumps(frame_update_template),
-                                     pack_data=True,
-                                     data_type=DataType.TypeString)
-                room_info['sync_time_stamp'] += 1
-
+            # 每个房间按照自己的截止时间转播玩家操作，落后的房间会补发若干帧
+            for room_number, tick_count in self.tick_scheduler.pop_due_rooms():
+                room_info = self.room_info_map.get(room_number)
+                if room_info is None:
+                    continue
+                self.drain_input_buffer(room_info)
+                for _ in range(tick_count):
+                    # TCP 保证按顺序送达，上一次发送的帧一定会先于这一帧被客户端收到，增量相对于上一次发送的帧计算
+                    is_keyframe = (not self.use_delta_frame_update or
+                                   room_info['sync_time_stamp'] % self.keyframe_interval == 0)
+                    if is_keyframe:
+                        frame_update_template['actions'] = room_info['actions']
+                    else:
+                        frame_update_template['actions'] = get_changed_actions(
+                            room_info['last_sent_actions'], room_info['actions'])
+                    room_info['last_sent_actions'] = dict(room_info['actions'])
+                    frame_update_template['is_keyframe'] = is_keyframe
+                    frame_update_template['sync_time_stamp'] = room_info['sync_time_stamp']
+                    # 整个房间的数据是一样的，只编码一次然后发送给所有的玩家
+                    self.broadcast_message(room_info['tcp_list'], frame_update_template)
+                    room_info['sync_time_stamp'] += 1
+
+            if self.matching_queue.need_notify():
+                self.notify_matching_state()
             self.lock.release()
 
-            # 保证服务器以 30FPS 的速度转播玩家操作
-            self.clock.tick(10)
+            if time.monotonic() - last_report_time >= self.tick_report_interval:
+                last_report_time = time.monotonic()
+                report = self.tick_scheduler.report()
+                if report['missed_deadlines'] or report['skipped_ticks']:
+                    print('server tick missed {missed_deadlines} deadlines, skipped {skipped_ticks} ticks, '
+                          'max lateness: {max_lateness_ms:.1f}ms, rooms: {rooms}'.format(**report))
 
-            # print('\rserver FPS: {}'.format(1/(time.time()-old_time + 1e-10)), end='')
+            time.sleep(self.tick_scheduler.get_wait_time())
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Fighting Aircraft Game Server')
     parser.add_argument('--room-max-player-number', default=1,
                         help='set the server room max player number')
+    parser.add_argument('--io-mode', default='selector', choices=['selector', 'thread'],
+                        help='selector: one event loop thread for all clients, thread: one thread per client')
+    parser.add_argument('--max-send-queue-bytes', default=1024 * 1024, type=int,
+                        help='selector mode: the max bytes queued for a client before applying the slow consumer policy')
+    parser.add_argument('--slow-consumer-policy', default=SlowConsumerPolicy.Disconnect.name,
+                        choices=[policy.name for policy in SlowConsumerPolicy],
+                        help='selector mode: how to handle a client whose send queue is full')
+    parser.add_argument('--workers', default=0, type=int,
+                        help='selector mode: run matched rooms in this many worker processes, 0 runs rooms in-process')
 
     args = parser.parse_args()
 
@@ -248,7 +743,10 @@ if __name__ == '__main__':
     #     process_other_command()
     # else:
     #     print('Invalid command. Use --start-server or --other-command.')
-    server = FightingAircraftGameServer()
+    server = FightingAircraftGameServer(io_mode=args.io_mode,
+                                        max_send_queue_bytes=args.max_send_queue_bytes,
+                                        slow_consumer_policy=SlowConsumerPolicy[args.slow_consumer_policy],
+                                        worker_count=args.workers)
     server.room_max_player_number = int(args.room_max_player_number)
     server.room_max_player_number = 1
     server.server_start()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from utils.SocketTcpTools import CallbackCommand, DataType, ProtocolError, TcpBaseTools
+
+
+class CompressionTest(unittest.TestCase):
+    def setUp(self):
+        self.tools = TcpBaseTools()
+        self.tools.max_frame_size = 64 * 1024
+        self.received = []
+        self.tools.set_callback_fun(self.callback)
+        self.tcp_client = object()
+
+    def tearDown(self):
+        self.tools.tcp_socket.close()
+
+    def callback(self, cmd, param):
+        if cmd == CallbackCommand.RecvData:
+            self.received.append(param['data'])
+
+    def decode(self, data, data_type=DataType.TypeBinary, compress=True):
+        """
+        打包之后再解码，返回交给 process_frames 的数据帧
+        :return:
+        """
+        frame = self.tools.pack_data(data, data_type=data_type, compress=compress)
+        return self.tools.get_frame_decoder(self.tcp_client).feed(frame)
+
+    def test_negotiated_compression(self):
+        self.tools.enable_compression(self.tcp_client)
+        data = b'frame update ' * 100
+        frames = self.decode(data)
+        self.assertLess(len(frames[0][1]), len(data))
+        self.tools.process_frames(frames, self.tcp_client)
+        self.assertEqual(self.received, [data])
+
+    def test_compression_without_negotiation(self):
+        frames = self.decode(b'frame update ' * 100)
+        with self.assertRaises(ProtocolError):
+            self.tools.process_frames(frames, self.tcp_client)
+        self.assertEqual(self.received, [])
+
+    def test_decompressed_size_limit(self):
+        self.tools.enable_compression(self.tcp_client)
+        data = b'\0' * self.tools.max_frame_size
+        self.tools.process_frames(self.decode(data), self.tcp_client)
+        self.assertEqual(self.received, [data])
+        # 很小的数据帧解压之后超过 max_frame_size，直接丢弃
+        frames = self.decode(data + b'\0')
+        self.assertLess(len(frames[0][1]), 1024)
+        self.tools.process_frames(frames, self.tcp_client)
+        self.assertEqual(len(self.received), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
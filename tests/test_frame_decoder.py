@@ -0,0 +1,94 @@
+import os
+import struct
+import sys
+import unittest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+from utils.SocketTcpTools import DataType, FrameDecoder, ProtocolError
+
+HEADER_BYTES = b'\x0a\x0b'
+HEADER_FORMAT = '2ssi'
+
+
+def pack_frame(data, data_type=DataType.TypeBinary, length=None):
+    """
+    按照协议打包一个数据帧
+    :param data:
+    :param data_type:
+    :param length: 帧头中的长度，默认为数据的真实长度
+    :return:
+    """
+    if length is None:
+        length = len(data)
+    return struct.pack(HEADER_FORMAT, HEADER_BYTES, data_type.value, length) + data
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def create_decoder(self, max_frame_size=1024):
+        return FrameDecoder(HEADER_BYTES, HEADER_FORMAT, buffer_size=16, max_frame_size=max_frame_size)
+
+    def test_split_header(self):
+        decoder = self.create_decoder()
+        frame = pack_frame(b'hello')
+        self.assertEqual(decoder.feed(frame[:1]), [])
+        self.assertEqual(decoder.feed(frame[1:5]), [])
+        self.assertEqual(decoder.feed(frame[5:9]), [])
+        self.assertEqual(decoder.feed(frame[9:]), [(DataType.TypeBinary.value, b'hello')])
+        self.assertEqual(decoder.pending_data(), b'')
+
+    def test_split_byte_by_byte(self):
+        decoder = self.create_decoder()
+        data = pack_frame(b'first') + pack_frame(b'second' * 10)
+        frames = []
+        for index in range(len(data)):
+            frames.extend(decoder.feed(data[index:index + 1]))
+        self.assertEqual(frames, [(DataType.TypeBinary.value, b'first'),
+                                  (DataType.TypeBinary.value, b'second' * 10)])
+
+    def test_coalesced_frames(self):
+        decoder = self.create_decoder()
+        data = pack_frame(b'a') + pack_frame(b'', DataType.TypeNone) + pack_frame(b'abc' * 20) + pack_frame(b'tail')
+        frames = decoder.feed(data + pack_frame(b'partial')[:-2])
+        self.assertEqual(frames, [(DataType.TypeBinary.value, b'a'),
+                                  (DataType.TypeNone.value, b''),
+                                  (DataType.TypeBinary.value, b'abc' * 20),
+                                  (DataType.TypeBinary.value, b'tail')])
+        self.assertEqual(decoder.pending_data(), pack_frame(b'partial')[:-2])
+        self.assertEqual(decoder.feed(b'al'), [(DataType.TypeBinary.value, b'partial')])
+
+    def test_resync_after_garbage(self):
+        decoder = self.create_decoder()
+        frames = decoder.feed(b'garbage' + pack_frame(b'data'))
+        self.assertEqual(frames, [(DataType.TypeBinary.value, b'data')])
+
+    def test_negative_length(self):
+        for length in (-1, -8, -20, -(1 << 31)):
+            decoder = self.create_decoder()
+            with self.assertRaises(ProtocolError):
+                decoder.feed(pack_frame(b'x' * 32, length=length))
+
+    def test_oversized_length(self):
+        decoder = self.create_decoder(max_frame_size=1024)
+        self.assertEqual(decoder.feed(pack_frame(b'x' * 1024)), [(DataType.TypeBinary.value, b'x' * 1024)])
+        with self.assertRaises(ProtocolError):
+            decoder.feed(pack_frame(b'', length=1025))
+        decoder = self.create_decoder(max_frame_size=1024)
+        with self.assertRaises(ProtocolError):
+            decoder.feed(pack_frame(b'', length=(1 << 31) - 1))
+
+    def test_buffer_grows_with_received_data(self):
+        decoder = self.create_decoder(max_frame_size=1 << 20)
+        self.assertEqual(decoder.feed(pack_frame(b'', length=1 << 20) + b'x' * 8), [])
+        # 帧头中的长度不会让缓存提前扩容
+        self.assertLess(len(decoder.data_buffer), 1024)
+        data = b'y' * ((1 << 20) - 8)
+        frames = []
+        for offset in range(0, len(data), 8192):
+            frames.extend(decoder.feed(data[offset:offset + 8192]))
+        self.assertEqual(frames, [(DataType.TypeBinary.value, b'x' * 8 + data)])
+
+
+if __name__ == '__main__':
+    unittest.main()
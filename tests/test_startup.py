@@ -0,0 +1,48 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 服务器不应该加载的客户端依赖
+HEAVY_MODULES = ('pygame', 'numpy', 'torch', 'PyQt5')
+# import server 的时间上限（秒），目前大约 0.07 秒，加载 numpy 或者 torch 之后会远远超过这个时间
+IMPORT_TIME_BUDGET = 0.5
+
+STARTUP_SCRIPT = '''
+import json
+import sys
+import time
+
+start_time = time.perf_counter()
+import server
+elapsed = time.perf_counter() - start_time
+print(json.dumps({'elapsed': elapsed,
+                  'loaded': [name for name in %r if name in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+class ServerStartupTest(unittest.TestCase):
+    def run_startup_script(self):
+        """
+        在新的进程中 import server，避免受到当前进程已经加载的模块影响
+        :return:
+        """
+        result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], cwd=PROJECT_DIR,
+                                capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+    def test_import_server_without_client_dependencies(self):
+        startup = self.run_startup_script()
+        self.assertEqual(startup['loaded'], [])
+
+    def test_import_server_time_budget(self):
+        startup = self.run_startup_script()
+        self.assertLess(startup['elapsed'], IMPORT_TIME_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,290 @@
+import json
+import struct
+from enum import Enum
+
+from utils.SocketTcpTools import DataType
+
+
+class CommandType(Enum):
+    cmd_none = 0
+    cmd_login = 1
+    cmd_login_resp = 2
+    cmd_matching_successful = 3
+    cmd_player_action = 4
+    cmd_frame_update = 5
+    cmd_matching_state_change = 6
+    cmd_game_over = 7
+
+
+# 二进制协议的版本号，协议格式发生变化的时候需要增加
+PROTOCOL_VERSION = 2
+# 可以解析的协议版本，版本 1 的 frame_update 没有 flags，每个玩家单独一项
+SUPPORTED_PROTOCOL_VERSIONS = (1, 2)
+
+'''
+二进制协议格式（小端）：
+所有消息都以 byte(version) + byte(command) 开头，之后的内容根据命令的不同而不同
+1. cmd_frame_update:   uint8(flags) + uint32(sync_time_stamp) + uint16(run count) +
+                       [uint16(first player_id) + uint8(player count) + uint16(InputState)] * count
+                       玩家 id 连续并且操作相同的玩家合并为一项（游程编码）
+                       版本 1: uint32(sync_time_stamp) + uint16(action count) + [uint16(player_id) + uint16(InputState)] * count
+2. cmd_player_action:  uint16(player_id) + uint16(InputState) + [uint32(hash_frame) + uint32(state_hash)]
+                       状态哈希是可选的，根据消息的长度判断是否存在，用于服务器检测客户端之间的不同步
+3. cmd_login:          uint16(player_id) + uint8(plane name length) + plane name(utf-8) + [uint8(capabilities)]
+4. cmd_login_resp:     uint16(player_id) + [uint8(capabilities)]
+                       capabilities 是可选的，旧的客户端不会发送，用于协商数据压缩等功能
+其余的命令数据量小、频率低，仍然使用 json 字符串
+'''
+message_header_format = '<BB'
+frame_update_format = '<BBBIH'
+action_run_format = '<HBH'
+frame_update_v1_format = '<BBIH'
+action_item_format = '<HH'
+player_action_format = '<BBHH'
+state_hash_format = '<II'
+login_format = '<BBHB'
+login_resp_format = '<BBH'
+
+frame_update_length = struct.calcsize(frame_update_format)
+action_run_length = struct.calcsize(action_run_format)
+frame_update_v1_length = struct.calcsize(frame_update_v1_format)
+action_item_length = struct.calcsize(action_item_format)
+player_action_length = struct.calcsize(player_action_format)
+state_hash_length = struct.calcsize(state_hash_format)
+
+# 登录时协商的功能
+CAPABILITY_COMPRESSION = 0x01
+capabilities_format = '<B'
+
+# 数据压缩使用的 zlib 预设字典，包含 json 消息中最常见的内容，越常见的内容越靠后
+COMPRESSION_DICTIONARY = ''.join([
+    '"plane_name": "Bf109", "plane_name": "Fw190", "plane_name": "P51", "plane_name": "Ju87", ',
+    '{"command": 7, "player_id": ',
+    '{"command": 6, "room_max_player_number": 2, "queue_current_players": 1}',
+    '{"command": 3, "sync_time_stamp": 0, "map_id": 1, "planes": [',
+    '{"player_id": 1, "position_x": 2000, "position_y": 2000, "plane_name": "Bf110"}, ',
+    '{"player_id": 2, "position_x": 2000, "position_y": 2000, "plane_name": "Bf110"}]}',
+]).encode()
+
+# frame_update 的 flags，关键帧包含房间内所有玩家的操作，其余的帧只包含发生变化的操作
+FRAME_FLAG_KEYFRAME = 0x01
+max_action_run_length = 255
+
+
+def get_changed_actions(previous_actions, actions):
+    """
+    获取相对于上一帧发生变化的玩家操作，用于发送增量的 frame_update
+    :param previous_actions: 上一次发送的完整操作
+    :param actions: 当前完整的操作
+    :return: 发生变化的操作，已经不存在的玩家的操作为 0 (InputState.NoInput)
+    """
+    changed_actions = {}
+    for player_id, action in actions.items():
+        if previous_actions.get(player_id) != action:
+            changed_actions[player_id] = action
+    for player_id in previous_actions:
+        if player_id not in actions:
+            changed_actions[player_id] = 0
+    return changed_actions
+
+
+def apply_frame_update(full_actions, message):
+    """
+    把接收到的 frame_update 合并到完整的操作中，关键帧直接替换，增量帧只更新发生变化的玩家，
+    没有 is_keyframe 字段的消息来自于不支持增量的服务器，都当作关键帧
+    :param full_actions: 客户端保存的完整操作，会被原地修改
+    :param message: 解码后的 frame_update
+    :return: full_actions
+    """
+    if message.get('is_keyframe', True):
+        full_actions.clear()
+    full_actions.update(message['actions'])
+    return full_actions
+
+
+def encode_action_runs(actions):
+    """
+    把玩家 id 连续并且操作相同的玩家合并为一项
+    :param actions: {player_id: action}
+    :return: [(first_player_id, player_count, action), ...]
+    """
+    action_runs = []
+    for player_id, action in sorted((int(player_id), action) for player_id, action in actions.items()):
+        if action_runs:
+            first_player_id, player_count, run_action = action_runs[-1]
+            if (run_action == action and first_player_id + player_count == player_id
+                    and player_count < max_action_run_length):
+                action_runs[-1] = (first_player_id, player_count + 1, run_action)
+                continue
+        action_runs.append((player_id, 1, action))
+    return action_runs
+
+
+def encode_frame_update(message):
+    action_runs = encode_action_runs(message['actions'])
+    flags = FRAME_FLAG_KEYFRAME if message.get('is_keyframe', True) else 0
+    data = bytearray(frame_update_length + action_run_length * len(action_runs))
+    struct.pack_into(frame_update_format, data, 0, PROTOCOL_VERSION, CommandType.cmd_frame_update.value,
+                     flags, message['sync_time_stamp'], len(action_runs))
+    offset = frame_update_length
+    for action_run in action_runs:
+        struct.pack_into(action_run_format, data, offset, *action_run)
+        offset += action_run_length
+    return bytes(data)
+
+
+def decode_frame_update(data):
+    version, _ = struct.unpack_from(message_header_format, data, 0)
+    if version == 1:
+        return decode_frame_update_v1(data)
+    _, _, flags, sync_time_stamp, run_count = struct.unpack_from(frame_update_format, data, 0)
+    # 和 json 解码的结果保持一致，玩家 id 使用字符串作为键
+    actions = {}
+    for first_player_id, player_count, action in struct.iter_unpack(
+            action_run_format, data[frame_update_length:frame_update_length + action_run_length * run_count]):
+        for player_id in range(first_player_id, first_player_id + player_count):
+            actions[str(player_id)] = action
+    return {'command': CommandType.cmd_frame_update.value,
+            'sync_time_stamp': sync_time_stamp,
+            'is_keyframe': bool(flags & FRAME_FLAG_KEYFRAME),
+            'actions': actions}
+
+
+def decode_frame_update_v1(data):
+    _, _, sync_time_stamp, action_count = struct.unpack_from(frame_update_v1_format, data, 0)
+    actions = {}
+    for player_id, action in struct.iter_unpack(
+            action_item_format, data[frame_update_v1_length:frame_update_v1_length + action_item_length * action_count]):
+        actions[str(player_id)] = action
+    return {'command': CommandType.cmd_frame_update.value,
+            'sync_time_stamp': sync_time_stamp,
+            'actions': actions}
+
+
+def encode_player_action(message):
+    data = struct.pack(player_action_format, PROTOCOL_VERSION, CommandType.cmd_player_action.value,
+                       message['player_id'], message['action'])
+    if 'state_hash' in message:
+        data += struct.pack(state_hash_format, message['hash_frame'], message['state_hash'])
+    return data
+
+
+def decode_player_action(data):
+    _, _, player_id, action = struct.unpack_from(player_action_format, data, 0)
+    message = {'command': CommandType.cmd_player_action.value,
+               'player_id': player_id,
+               'action': action}
+    if len(data) >= player_action_length + state_hash_length:
+        message['hash_frame'], message['state_hash'] = struct.unpack_from(
+            state_hash_format, data, player_action_length)
+    return message
+
+
+def get_capabilities(message):
+    return CAPABILITY_COMPRESSION if message.get('compression') else 0
+
+
+def set_capabilities(message, data, offset):
+    """
+    解析消息末尾可选的 capabilities
+    :param message: 解码后的消息，会被原地修改
+    :param data:
+    :param offset: capabilities 的位置
+    :return:
+    """
+    capabilities = struct.unpack_from(capabilities_format, data, offset)[0] if len(data) > offset else 0
+    message['compression'] = bool(capabilities & CAPABILITY_COMPRESSION)
+    return message
+
+
+def encode_login(message):
+    plane_name = message['plane_name'].encode()
+    return (struct.pack(login_format, PROTOCOL_VERSION, CommandType.cmd_login.value,
+                        message['player_id'], len(plane_name)) + plane_name +
+            struct.pack(capabilities_format, get_capabilities(message)))
+
+
+def decode_login(data):
+    _, _, player_id, name_length = struct.unpack_from(login_format, data, 0)
+    name_start = struct.calcsize(login_format)
+    message = {'command': CommandType.cmd_login.value,
+               'player_id': player_id,
+               'plane_name': bytes(data[name_start:name_start + name_length]).decode()}
+    return set_capabilities(message, data, name_start + name_length)
+
+
+def encode_login_resp(message):
+    return (struct.pack(login_resp_format, PROTOCOL_VERSION, CommandType.cmd_login_resp.value,
+                        message['player_id']) +
+            struct.pack(capabilities_format, get_capabilities(message)))
+
+
+def decode_login_resp(data):
+    _, _, player_id = struct.unpack_from(login_resp_format, data, 0)
+    message = {'command': CommandType.cmd_login_resp.value,
+               'player_id': player_id}
+    return set_capabilities(message, data, struct.calcsize(login_resp_format))
+
+
+command_values = set(command_type.value for command_type in CommandType)
+
+binary_encoders = {
+    CommandType.cmd_frame_update.value: encode_frame_update,
+    CommandType.cmd_player_action.value: encode_player_action,
+    CommandType.cmd_login.value: encode_login,
+    CommandType.cmd_login_resp.value: encode_login_resp,
+}
+
+binary_decoders = {
+    CommandType.cmd_frame_update.value: decode_frame_update,
+    CommandType.cmd_player_action.value: decode_player_action,
+    CommandType.cmd_login.value: decode_login,
+    CommandType.cmd_login_resp.value: decode_login_resp,
+}
+
+
+def encode_message(message, use_binary=True):
+    """
+    将消息编码为发送的数据，频繁发送的命令使用二进制协议，其余的使用 json
+    :param message: 消息的 dict，必须包含 command
+    :param use_binary: 是否使用二进制协议
+    :return: (data, data_type)
+    """
+    encoder = binary_encoders.get(message['command'])
+    if use_binary and encoder is not None:
+        return encoder(message), DataType.TypeBinary
+    return json.dumps(message), DataType.TypeString
+
+
+def decode_message(data, data_type):
+    """
+    将接收到的数据解码为消息的 dict，二进制和 json 两种格式都可以解析，
+    无法解析的数据（未知的版本或者命令、长度不够、格式错误）会被丢弃并记录，不会向传输层抛出异常
+    :param data: 接收到的数据
+    :param data_type: 数据类型: DataType.xxx
+    :return: 消息的 dict，数据无效的时候返回 None
+    """
+    try:
+        message = parse_message(data, data_type)
+    except (struct.error, ValueError, UnicodeDecodeError) as e:
+        print('invalid message dropped: {!r}'.format(e))
+        return None
+    if not isinstance(message, dict) or message.get('command') not in command_values:
+        print('invalid message dropped: {!r}'.format(bytes(data[:64])))
+        return None
+    return message
+
+
+def parse_message(data, data_type):
+    """
+    解码消息，数据无效的时候抛出异常，由 decode_message 处理
+    """
+    if data_type == DataType.TypeBinary:
+        version, command = struct.unpack_from(message_header_format, data, 0)
+        if version not in SUPPORTED_PROTOCOL_VERSIONS:
+            raise ValueError('unsupported protocol version: {}'.format(version))
+        decoder = binary_decoders.get(command)
+        if decoder is None:
+            raise ValueError('unsupported binary command: {}'.format(command))
+        return decoder(data)
+    return json.loads(bytes(data).decode())
@@ -1,15 +1,15 @@
 import inspect
+import selectors
 import socket
 import struct
 import sys
 import threading
 import time
+import traceback
+import zlib
+from collections import deque
 from enum import Enum
 
-import numpy as np
-
-from PyQt5.QtWidgets import QApplication
-
 
 class CallbackCommand(Enum):
     CommandNone = 0
@@ -25,26 +25,168 @@ class DataType(Enum):
     TypeBinary = b'\4'
 
 
-class FrameInfo:
-    def __init__(self):
-        self.data_type = None
-        self.data_all_length = 0
-        self.data_recv_length = 0
-        self.data_buffer = b''
+# 帧头中数据类型字节的最高位，表示数据体经过了 zlib 压缩
+COMPRESSED_FLAG = 0x80
+# 单个数据帧的数据体（解压之后）的最大长度，帧头中超过这个长度的数据帧直接视为协议错误
+MAX_FRAME_SIZE = 1 << 20
+
+
+class ProtocolError(Exception):
+    """
+    对方发送的数据不符合协议，无法继续解析这个连接之后的数据，需要断开连接
+    """
+    pass
+
+
+class SlowConsumerPolicy(Enum):
+    # 发送队列超过上限的时候，丢弃队列中最旧的、可以被新数据替代的消息，仍然超过上限就断开连接
+    DropStale = 0
+    # 相同 coalesce_key 的消息在队列中只保留最新的一条，仍然超过上限就断开连接
+    Coalesce = 1
+    # 发送队列超过上限的时候直接断开连接
+    Disconnect = 2
+
 
-    def set_buffer_data(self, data):
-        self.data_buffer = data
+def send_data_parts(tcp_socket, data_parts):
+    """
+    尽量使用 sendmsg 把多段数据一次发送出去，避免为了发送而拼接数据，不支持 sendmsg 的平台退化为 send
+    :param tcp_socket:
+    :param data_parts: 多段数据的 list
+    :return: 本次发送出去的数据长度
+    """
+    if hasattr(tcp_socket, 'sendmsg'):
+        return tcp_socket.sendmsg(data_parts)
+    return tcp_socket.send(b''.join(data_parts))
 
-    def set(self, data_type, data_all_length):
-        self.data_type = data_type
-        self.data_all_length = data_all_length
-        self.data_recv_length = 0
+
+def get_remaining_parts(data_parts, sent_length):
+    """
+    获取多段数据中还没有发送出去的部分
+    :param data_parts:
+    :param sent_length: 已经发送的数据长度
+    :return:
+    """
+    remaining_parts = []
+    for data_part in data_parts:
+        if sent_length >= len(data_part):
+            sent_length -= len(data_part)
+            continue
+        remaining_parts.append(memoryview(data_part)[sent_length:])
+        sent_length = 0
+    return remaining_parts
+
+
+class FrameDecoder:
+    """
+    每一个 socket 连接单独拥有一个解码器，保存自己还没有解析完成的数据，
+    防止多个客户端的数据写到同一个缓存里面。
+    数据通过 recv_into 直接写入预先分配好的缓存，帧头使用 memoryview 原地解析，
+    只有在交给回调函数的时候才会把完整的数据帧拷贝出来一次
+    """
+    def __init__(self, header_bytes, header_format, buffer_size=65536, max_frame_size=MAX_FRAME_SIZE):
+        self.header_bytes = header_bytes
+        self.header_format = header_format
+        self.header_length = struct.calcsize(header_format)
+        self.max_frame_size = max_frame_size
+        self.data_buffer = bytearray(buffer_size)
+        self.buffer_view = memoryview(self.data_buffer)
+        self.read_offset = 0        # 还没有解析的数据的起始位置
+        self.write_offset = 0       # 下一次接收数据写入的位置
 
     def reset(self):
-        self.data_type = None
-        self.data_all_length = 0
-        self.data_recv_length = 0
-        self.data_buffer = b''
+        self.read_offset = 0
+        self.write_offset = 0
+
+    def pending_data(self):
+        """
+        获取已经接收但是还没有解析成完整数据帧的数据
+        :return:
+        """
+        return self.buffer_view[self.read_offset:self.write_offset].tobytes()
+
+    def reserve(self, size):
+        """
+        保证缓存尾部至少有 size 字节的空闲空间，优先把未解析的数据挪到缓存头部，不够的话再扩容
+        :param size:
+        :return:
+        """
+        if len(self.data_buffer) - self.write_offset >= size:
+            return
+        data_left = self.write_offset - self.read_offset
+        if self.read_offset:
+            # 源和目标区域可能重叠，先拷贝出来，这里只有不完整的一帧数据
+            self.data_buffer[:data_left] = self.buffer_view[self.read_offset:self.write_offset].tobytes()
+            self.read_offset = 0
+            self.write_offset = data_left
+        if len(self.data_buffer) - self.write_offset < size:
+            new_size = len(self.data_buffer)
+            while new_size - self.write_offset < size:
+                new_size *= 2
+            self.buffer_view.release()
+            self.data_buffer.extend(bytes(new_size - len(self.data_buffer)))
+            self.buffer_view = memoryview(self.data_buffer)
+
+    def recv_into(self, tcp_socket, recv_size):
+        """
+        从 socket 中直接接收数据到缓存
+        :param tcp_socket:
+        :param recv_size: 本次最多接收的数据长度
+        :return: 接收到的数据长度，0 表示对方关闭了连接
+        """
+        self.reserve(recv_size)
+        recv_length = tcp_socket.recv_into(self.buffer_view[self.write_offset:], recv_size)
+        self.write_offset += recv_length
+        return recv_length
+
+    def feed(self, recv_data):
+        """
+        写入已经接收到的数据，并返回所有已经接收完整的数据帧
+        :param recv_data: 接收到的原始数据
+        :return: [(data_type, data), ...]
+        """
+        self.reserve(len(recv_data))
+        self.buffer_view[self.write_offset:self.write_offset + len(recv_data)] = recv_data
+        self.write_offset += len(recv_data)
+        return self.parse_frames()
+
+    def parse_frames(self):
+        """
+        从缓存中解析出所有完整的数据帧，数据体长度不合法的时候抛出 ProtocolError
+        :return: [(data_type, data), ...]
+        """
+        frames = []
+        while True:
+            data_left = self.write_offset - self.read_offset
+            # 帧头都还没有接收完，等待下一次的数据
+            if data_left < self.header_length:
+                break
+            header = struct.unpack_from(self.header_format, self.buffer_view, self.read_offset)
+            if header[0] != self.header_bytes:
+                # 协议解析出问题了，丢弃数据直到下一个可能的帧头
+                next_offset = self.data_buffer.find(
+                    self.header_bytes, self.read_offset + 1, self.write_offset)
+                if next_offset == -1:
+                    next_offset = self.write_offset - (len(self.header_bytes) - 1)
+                print('invalid frame header, {} bytes dropped. '.format(next_offset - self.read_offset))
+                self.read_offset = next_offset
+                continue
+            if header[2] < 0 or header[2] > self.max_frame_size:
+                # 长度不合法的时候无法确定下一帧的位置，继续解析只会得到错误的数据甚至死循环
+                raise ProtocolError('invalid frame length: {}'.format(header[2]))
+            frame_length = self.header_length + header[2]
+            # 数据体还没有接收完，缓存只按照实际接收到的数据扩容，不按照帧头中的长度提前分配
+            if data_left < frame_length:
+                break
+            data_start = self.read_offset + self.header_length
+            frames.append((header[1], self.buffer_view[data_start:self.read_offset + frame_length].tobytes()))
+            self.read_offset += frame_length
+
+        # 数据全部处理完的时候直接回到缓存的起始位置
+        if self.read_offset == self.write_offset:
+            self.read_offset = 0
+            self.write_offset = 0
+
+        return frames
 
 
 class TcpBaseTools:
@@ -61,12 +203,20 @@ class TcpBaseTools:
         self.header_length = 8
         self.tcp_socket = None
         self.connect_state = False
-        self.frame_info = FrameInfo()
+        self.frame_decoders = {}        # 每一个 socket 对应的解码器
+        # 数据压缩，只对协商过支持压缩的 socket 压缩超过阈值的数据体，接收的时候根据帧头自动解压
+        self.compression_sockets = set()
+        self.compression_threshold = 512
+        self.compression_level = 6
+        self.compression_dictionary = b''   # zlib 的预设字典，收发双方必须一致
+        self.max_frame_size = MAX_FRAME_SIZE    # 接收的单个数据帧的最大长度
 
         # 先创建一个socket
         self.socket_init()
 
     def close_socket(self, tcp_socket=None):
+        self.release_frame_decoder(tcp_socket)
+        self.compression_sockets.discard(tcp_socket)
         # 对主程序的通知应该放在此处
         if self.callback_fun:
             self.callback_fun(CallbackCommand.SocketClose, tcp_socket)
@@ -115,86 +265,168 @@ def example_callback(callback_cmd, param):
         else:
             return False, None
 
-    def process_raw_data(self, recv_data, tcp_client):
+    def get_frame_decoder(self, tcp_socket):
         """
-        处理接收到的原始数据，核心代码
-        :param recv_data:
+        获取 socket 对应的解码器，没有的话创建一个新的
+        :param tcp_socket:
         :return:
         """
-        '''
-        关于操作：
-            本函数应该具有递归功能，否则无法处理复杂任务
-        关于消息接收的逻辑处理：
-        1. 首先判断当前是否已经接收过帧头 (self.frame_info.data_type is not None)
-            接收过：
-                根据帧头的数据长度接收对应的数据体内容
-            没接收过：
-            判断当前接收的数据长度是否满足帧头的长度
-                满足：尝试解析
-                    解析失败：正常传输数据
-                    解析成功：如果有其他的数据，继续接收处理后续的数据
-                不满足：将本次数据输出，丢弃此次的数据 !!!
-        '''
-        # 如果已经接收过数据头，直接继续接收内容
-        if self.frame_info.data_type is not None:
-            # 首先计算剩余的数据包长度
-            recv_len_left = self.frame_info.data_all_length - self.frame_info.data_recv_length
-            # 然后计算本次可以接收的数据长度，选取数据长度和剩余接收长度的最小值
-            recv_len_real = min(recv_len_left, len(recv_data))
-            self.frame_info.data_buffer += recv_data[:recv_len_real]
-            # 更新对应的接收的数据长度
-            self.frame_info.data_recv_length = len(self.frame_info.data_buffer)
-            # 判断当前是否已经接受完本帧的内容
-            if self.frame_info.data_recv_length >= self.frame_info.data_all_length:
-                # 根据回调函数返回对应的内容
-                if self.callback_fun is not None:
-                    self.callback_fun(
-                        CallbackCommand.RecvData,
-                        {'tcp_client': tcp_client, 'data': self.frame_info.data_buffer})
-                else:
-                    print('no callback function, recv data: {}'.format(self.frame_info.data_buffer))
-                # 从剩余的数据中尝试检索出对应的数据头
-                # 首先更新 recv_data 的数据的内容
-                # print(self.frame_info.data_buffer)
-                self.frame_info.reset()
-                recv_data = recv_data[recv_len_real:len(recv_data)]
-                if len(recv_data) != 0:
-                    self.process_raw_data(recv_data, tcp_client)
-            else:
-                return
-            # 从剩余的数据中尝试解析数据头
+        frame_decoder = self.frame_decoders.get(tcp_socket)
+        if frame_decoder is None:
+            frame_decoder = FrameDecoder(self.header_bytes, self.header_format,
+                                         max_frame_size=self.max_frame_size)
+            self.frame_decoders[tcp_socket] = frame_decoder
+        return frame_decoder
+
+    def release_frame_decoder(self, tcp_socket):
+        self.frame_decoders.pop(tcp_socket, None)
+
+    def enable_compression(self, tcp_socket):
+        """
+        对方支持压缩之后，发送给这个 socket 的较大的数据体会进行压缩
+        :param tcp_socket:
+        :return:
+        """
+        self.compression_sockets.add(tcp_socket)
+
+    def compress_payload(self, data):
+        if self.compression_dictionary:
+            compressor = zlib.compressobj(self.compression_level, zdict=self.compression_dictionary)
         else:
-            if len(recv_data) >= self.header_length:
-                ret = self.process_protocol(recv_data[:self.header_length])
-                if ret[0]:
-                    # 打印出协议对应的内容
-                    # print(ret[1])
-                    self.frame_info.set(ret[1][1], ret[1][2])
-                    # 此处还得继续判断当前是否转换完了，如果没有的话需要继续转换接收到的内容
-
-                    recv_data_body = recv_data[self.header_length:len(recv_data)]
-                    if len(recv_data_body) != 0:
-                        self.process_raw_data(recv_data_body, tcp_client)
-                else:
-                    print(recv_data)
-                    # 此处应该是协议解析出问题了
+            compressor = zlib.compressobj(self.compression_level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress_payload(self, data):
+        """
+        解压数据体，解压之后的长度最多为 max_frame_size，防止很小的数据帧解压出很大的数据
+        :param data:
+        :return:
+        """
+        if self.compression_dictionary:
+            decompressor = zlib.decompressobj(zdict=self.compression_dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, self.max_frame_size)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise zlib.error('decompressed data exceeds {} bytes or is incomplete'.format(self.max_frame_size))
+        return data
+
+    def recv_frames(self, tcp_socket):
+        """
+        从 socket 中接收数据并直接解析出完整的数据帧
+        :param tcp_socket:
+        :return: (接收到的数据长度, [(data_type, data), ...])，长度为 0 表示对方关闭了连接
+        """
+        frame_decoder = self.get_frame_decoder(tcp_socket)
+        recv_length = frame_decoder.recv_into(tcp_socket, self.buffer_size)
+        if recv_length == 0:
+            return 0, []
+        return recv_length, frame_decoder.parse_frames()
 
+    def process_frames(self, frames, tcp_client):
+        """
+        把解析完成的数据帧交给回调函数，没有协商过压缩的连接发送了压缩的数据帧的时候抛出 ProtocolError
+        :param frames: [(data_type, data), ...]
+        :param tcp_client:
+        :return:
+        """
+        for data_type, data in frames:
+            if data_type[0] & COMPRESSED_FLAG:
+                if tcp_client not in self.compression_sockets:
+                    # 没有协商过压缩的连接不应该发送压缩的数据
+                    raise ProtocolError('compressed frame from a connection without compression')
+                try:
+                    data = self.decompress_payload(data)
+                except zlib.error as e:
+                    print('invalid compressed frame, dropped: {}'.format(e))
+                    continue
+                data_type = bytes([data_type[0] & ~COMPRESSED_FLAG])
+            try:
+                data_type = DataType(data_type)
+            except ValueError:
+                print('invalid data type: {}, frame dropped'.format(data_type))
+                continue
+            # 根据回调函数返回对应的内容
+            if self.callback_fun is not None:
+                self.callback_fun(
+                    CallbackCommand.RecvData,
+                    {'tcp_client': tcp_client, 'data': data, 'data_type': data_type})
             else:
-                print(recv_data)
+                print('no callback function, recv data: {}'.format(data))
+
+    def shutdown_broken_socket(self, tcp_socket, error):
+        """
+        对方发送的数据不符合协议的时候关闭连接的读取，接收线程之后收到长度为 0 的数据，按照正常断开的流程处理
+        :param tcp_socket:
+        :param error:
+        :return:
+        """
+        print('protocol error: {!r}, disconnect it'.format(error))
+        try:
+            tcp_socket.shutdown(socket.SHUT_RD)
+        except OSError as e:
+            print(e)
 
-    def pack_data(self, data, data_type=DataType.TypeNone):
+    def process_raw_data(self, recv_data, tcp_client):
+        """
+        处理接收到的原始数据，核心代码
+        :param recv_data:
+        :param tcp_client: 接收数据的 socket，每个 socket 使用自己的解码器
+        :return:
+        """
+        self.process_frames(self.get_frame_decoder(tcp_client).feed(recv_data), tcp_client)
+
+    def pack_data(self, data, data_type=DataType.TypeNone, compress=False):
         """
         对发送数据进行打包，打包数据包括
         :param data: 打包原始数据
         :param data_type: 数据类型: DataType.xxx
+        :param compress: 是否允许压缩，只有数据体超过 compression_threshold 并且压缩后更小的时候才会压缩
         :return:
         """
-        if data_type == DataType.TypeString:
-            data = data.encode()
-        data_pack = struct.pack(self.header_format, self.header_bytes, data_type.value, len(data))
+        data_pack, data = self.pack_data_parts(data=data, data_type=data_type, compress=compress)
         # print("datalen:{}".format(len(data)))
         return data_pack + data
 
+    def pack_data_parts(self, data, data_type=DataType.TypeNone, compress=False):
+        """
+        对发送数据进行打包，但是不拼接帧头和数据，便于同一份数据发送给多个 socket
+        :param data: 打包原始数据
+        :param data_type: 数据类型: DataType.xxx
+        :param compress: 是否允许压缩
+        :return: [帧头, 数据]
+        """
+        if data_type == DataType.TypeString:
+            data = data.encode()
+        data_type_value = data_type.value
+        if compress and len(data) >= self.compression_threshold:
+            compressed_data = self.compress_payload(data)
+            if len(compressed_data) < len(data):
+                data = compressed_data
+                data_type_value = bytes([data_type_value[0] | COMPRESSED_FLAG])
+        data_pack = struct.pack(self.header_format, self.header_bytes, data_type_value, len(data))
+        return [data_pack, data]
+
+    def pack_broadcast_parts(self, tcp_sockets, data, pack_data=False, data_type=DataType.TypeNone):
+        """
+        为广播打包数据，压缩和不压缩的数据最多各打包一次
+        :param tcp_sockets:
+        :param data:
+        :param pack_data:
+        :param data_type:
+        :return: [(tcp_socket, data_parts), ...]
+        """
+        if not pack_data:
+            return [(tcp_socket, [data]) for tcp_socket in tcp_sockets]
+        packed_parts = {}
+        socket_parts = []
+        for tcp_socket in tcp_sockets:
+            compress = tcp_socket in self.compression_sockets
+            if compress not in packed_parts:
+                packed_parts[compress] = self.pack_data_parts(data=data, data_type=data_type, compress=compress)
+            socket_parts.append((tcp_socket, packed_parts[compress]))
+        return socket_parts
+
 
 class TcpSererTools(TcpBaseTools):
     def __init__(self, host, port):
@@ -241,7 +473,7 @@ class TcpSererTools(TcpBaseTools):
         while not close_event.is_set():
             try:
                 if tcp_socket:
-                    recv_data = tcp_socket.recv(self.buffer_size)
+                    recv_length, frames = self.recv_frames(tcp_socket)
                 else:
                     Warning('the tcp_client is not available, skipping client process! ')
                     break
@@ -253,10 +485,11 @@ class TcpSererTools(TcpBaseTools):
             # ----------------------------------------------------------------
             # recv_data = tcp_socket.recv(self.buffer_size)
             # 这个指的是客户端发来的断开连接的消息
-            if recv_data == b'':
+            if recv_length == 0:
                 self.lock.acquire()
                 # print('receive FIN!')
                 del self.tcp_clients_2_thread_info[tcp_socket]
+                self.release_frame_decoder(tcp_socket)
                 close_event.set()
                 # 此处应该编写挥手指令
                 # 步骤1: 发起关闭
@@ -272,7 +505,10 @@ class TcpSererTools(TcpBaseTools):
                 continue
 
             # 另外编写函数处理对应的内容
-            self.process_raw_data(recv_data, tcp_socket)
+            try:
+                self.process_frames(frames, tcp_socket)
+            except ProtocolError as e:
+                self.shutdown_broken_socket(tcp_socket, e)
 
     # 开始的线程函数，外部最好调用 start() 函数，不要调用此函数
     # 否则会阻塞
@@ -334,21 +570,36 @@ class TcpSererTools(TcpBaseTools):
     #     else:
     #         return self.tcp_clients_2_event[client_idx]
 
-    def send(self, tcp_socket, data, pack_data=False, data_type=DataType.TypeNone):
+    def send(self, tcp_socket, data, pack_data=False, data_type=DataType.TypeNone, coalesce_key=None):
         """
         向客户端发送数据
         :param data_type:
         :param pack_data:
         :param tcp_socket:
         :param data:
+        :param coalesce_key: 和 TcpSelectorServerTools 保持接口一致，这里的发送是阻塞的，不会丢弃数据
         :return:
         """
         if pack_data:
-            data = self.pack_data(data=data, data_type=data_type)
+            data_parts = self.pack_data_parts(data=data, data_type=data_type,
+                                              compress=tcp_socket in self.compression_sockets)
+        else:
+            data_parts = [data]
+        self.send_parts(tcp_socket, data_parts)
+
+    def send_parts(self, tcp_socket, data_parts):
+        """
+        向客户端发送多段数据，保证数据全部发送完成
+        :param tcp_socket:
+        :param data_parts:
+        :return:
+        """
         self.lock.acquire()
         try:
-            if tcp_socket in list(self.tcp_clients_2_thread_info.keys()):
-                tcp_socket.send(data)
+            if tcp_socket in self.tcp_clients_2_thread_info:
+                sent_length = send_data_parts(tcp_socket, data_parts)
+                for data_part in get_remaining_parts(data_parts, sent_length):
+                    tcp_socket.sendall(data_part)
         except Exception as e:
             self.close_socket(tcp_socket)
             if self.callback_fun:
@@ -357,9 +608,513 @@ class TcpSererTools(TcpBaseTools):
         # print('start send data! ')
         self.lock.release()
 
-    def send_all_clients(self, data, pack_data=False, data_type=DataType.TypeNone):
-        for client in list(self.tcp_clients_2_thread_info.keys()):
-            self.send(client, data, pack_data=pack_data, data_type=data_type)
+    def broadcast(self, tcp_sockets, data, pack_data=False, data_type=DataType.TypeNone, coalesce_key=None):
+        """
+        向多个客户端发送同一份数据，数据只打包一次
+        :param tcp_sockets:
+        :param data:
+        :param pack_data:
+        :param data_type:
+        :param coalesce_key:
+        :return:
+        """
+        for tcp_socket, data_parts in self.pack_broadcast_parts(list(tcp_sockets), data, pack_data, data_type):
+            self.send_parts(tcp_socket, data_parts)
+
+    def send_all_clients(self, data, pack_data=False, data_type=DataType.TypeNone, coalesce_key=None):
+        self.broadcast(list(self.tcp_clients_2_thread_info.keys()), data,
+                       pack_data=pack_data, data_type=data_type, coalesce_key=coalesce_key)
+
+
+class OutboundMessage:
+    def __init__(self, data_parts, coalesce_key=None):
+        self.data_parts = [memoryview(data_part) for data_part in data_parts]
+        self.length = sum(len(data_part) for data_part in self.data_parts)
+        # 带有 coalesce_key 的消息可以被之后相同 key 的消息替代
+        self.coalesce_key = coalesce_key
+        # 已经发送了一部分的消息不能再被丢弃或者替换，否则数据流会错乱
+        self.started = False
+
+
+class SendQueue:
+    """
+    每个客户端独立的有界发送队列，由事件循环负责发送，队列超过上限时按照 SlowConsumerPolicy 处理
+    """
+    max_parts_per_send = 64
+
+    def __init__(self, max_bytes, policy=SlowConsumerPolicy.Disconnect):
+        self.messages = deque()
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.queued_bytes = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def push(self, data_parts, coalesce_key=None, started=False):
+        """
+        把消息加入发送队列
+        :param data_parts: 多段数据的 list
+        :param coalesce_key: 可以相互替代的消息使用相同的 key，None 表示消息不能丢弃
+        :param started: 消息是否已经发送了一部分
+        :return: 队列是否仍然在上限之内，返回 False 的时候需要断开连接
+        """
+        if self.policy == SlowConsumerPolicy.Coalesce and coalesce_key is not None:
+            for message in self.messages:
+                if message.coalesce_key == coalesce_key and not message.started:
+                    self.messages.remove(message)
+                    self.queued_bytes -= message.length
+                    self.coalesced_count += 1
+                    break
+        message = OutboundMessage(data_parts, coalesce_key)
+        message.started = started
+        self.messages.append(message)
+        self.queued_bytes += message.length
+        # 只有一条消息的时候无论多大都需要发送出去
+        if self.queued_bytes <= self.max_bytes or len(self.messages) == 1:
+            return True
+        if self.policy != SlowConsumerPolicy.Disconnect:
+            self.drop_stale()
+        return self.queued_bytes <= self.max_bytes
+
+    def drop_stale(self):
+        """
+        从最旧的消息开始丢弃可以被替代的消息，直到队列回到上限之内
+        :return:
+        """
+        kept_messages = deque()
+        while self.messages:
+            message = self.messages.popleft()
+            if self.queued_bytes > self.max_bytes and message.coalesce_key is not None and not message.started:
+                self.queued_bytes -= message.length
+                self.dropped_count += 1
+                continue
+            kept_messages.append(message)
+        self.messages = kept_messages
+
+    def write_to(self, tcp_socket):
+        """
+        把队列头部的多条消息用一次 sendmsg 尽可能多的发送出去
+        :param tcp_socket:
+        :return: 本次发送出去的数据长度
+        """
+        data_parts = []
+        for message in self.messages:
+            data_parts.extend(message.data_parts)
+            if len(data_parts) >= self.max_parts_per_send:
+                break
+        if not data_parts:
+            return 0
+        sent_length = send_data_parts(tcp_socket, data_parts)
+        remaining_length = sent_length
+        while remaining_length and self.messages:
+            message = self.messages[0]
+            if remaining_length >= message.length:
+                remaining_length -= message.length
+                self.queued_bytes -= message.length
+                self.messages.popleft()
+                continue
+            message.data_parts = get_remaining_parts(message.data_parts, remaining_length)
+            message.length -= remaining_length
+            message.started = True
+            self.queued_bytes -= remaining_length
+            remaining_length = 0
+        return sent_length
+
+
+class ConnectionInfo:
+    def __init__(self, tcp_socket, address, max_send_queue_bytes, slow_consumer_policy):
+        self.tcp_socket = tcp_socket
+        self.address = address
+        # 还没有发送出去的消息，由事件循环负责发送
+        self.send_queue = SendQueue(max_send_queue_bytes, slow_consumer_policy)
+        # 需要断开的连接交给事件循环关闭，避免在调用 send 的线程中触发 SocketClose 回调
+        self.close_pending = False
+
+
+class TcpSelectorServerTools(TcpBaseTools):
+    """
+    基于 selectors 的服务器，所有客户端连接都由同一个事件循环线程进行复用，
+    不再为每一个客户端单独创建线程，对外接口和 TcpSererTools 保持一致
+    """
+    def __init__(self, host, port, max_send_queue_bytes=1024 * 1024,
+                 slow_consumer_policy=SlowConsumerPolicy.Disconnect):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.event_loop_thread = None
+        self.tcp_clients_2_connection_info = {}
+        self.host = host
+        self.port = port
+        self.max_connections = 128
+        self.select_timeout = 0.5
+        # 每个客户端发送队列的上限，以及超过上限之后的处理策略
+        self.max_send_queue_bytes = max_send_queue_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        # 用于在其他线程发送数据的时候唤醒事件循环，更新对应 socket 的监听事件
+        self.wakeup_recv_socket, self.wakeup_send_socket = socket.socketpair()
+        self.wakeup_recv_socket.setblocking(False)
+        self.wakeup_send_socket.setblocking(False)
+        # 其他线程交给事件循环线程执行的函数
+        self.pending_calls = deque()
+
+    def close_socket(self, tcp_socket=None):
+        if tcp_socket:
+            self.lock.acquire()
+            connection_info = self.tcp_clients_2_connection_info.pop(tcp_socket, None)
+            if connection_info is not None:
+                self.selector.unregister(tcp_socket)
+            self.lock.release()
+            if connection_info is None:
+                return
+            print("socket: {} has closed, it has been remove from the connection pool. ".format(
+                connection_info.address))
+            tcp_socket.close()
+            super().close_socket(tcp_socket=tcp_socket)
+        else:
+            if self.tcp_socket:
+                self.exit_event.set()
+                self.wakeup()
+                if self.event_loop_thread:
+                    self.event_loop_thread.join()
+                for client in list(self.tcp_clients_2_connection_info.keys()):
+                    self.close_socket(client)
+                self.selector.close()
+                self.tcp_socket.close()
+                self.tcp_socket = None
+
+    def wakeup(self):
+        """
+        唤醒事件循环，主要用于在其他线程中有新的数据需要发送的时候
+        :return:
+        """
+        try:
+            self.wakeup_send_socket.send(b'\0')
+        except (BlockingIOError, OSError):
+            # 缓冲区满说明事件循环已经有待处理的唤醒信号了
+            pass
+
+    def call_soon(self, func):
+        """
+        让事件循环线程执行 func，可以在任何线程中调用，用于需要和连接的收发在同一个线程中进行的操作，
+        例如接管其他进程移交过来的连接
+        :param func: 没有参数的函数
+        :return:
+        """
+        self.pending_calls.append(func)
+        self.wakeup()
+
+    def accept_client(self):
+        """
+        接受新的客户端连接并注册到事件循环中
+        :return:
+        """
+        try:
+            tcp_client, tcp_client_address = self.tcp_socket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        tcp_client.setblocking(False)
+        tcp_client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+        self.lock.acquire()
+        self.tcp_clients_2_connection_info[tcp_client] = ConnectionInfo(
+            tcp_client, tcp_client_address, self.max_send_queue_bytes, self.slow_consumer_policy)
+        self.selector.register(tcp_client, selectors.EVENT_READ, data=None)
+        self.lock.release()
+        print("new client connected, client address: {}, total client count: {}".format(
+            tcp_client_address, len(self.tcp_clients_2_connection_info)))
+
+    def read_client(self, tcp_socket):
+        """
+        socket 可读的时候读取数据并交给协议解析
+        :param tcp_socket:
+        :return:
+        """
+        # 同一轮 select 中已经被 detach_client 移交出去的连接
+        if tcp_socket not in self.tcp_clients_2_connection_info:
+            return
+        try:
+            recv_length, frames = self.recv_frames(tcp_socket)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            print(e)
+            self.close_socket(tcp_socket)
+            return
+        # 这个指的是客户端发来的断开连接的消息
+        if recv_length == 0:
+            self.close_socket(tcp_socket)
+            return
+        self.process_frames(frames, tcp_socket)
+
+    def write_client(self, tcp_socket):
+        """
+        socket 可写的时候尽可能多的把缓存的数据发送出去
+        :param tcp_socket:
+        :return:
+        """
+        self.lock.acquire()
+        connection_info = self.tcp_clients_2_connection_info.get(tcp_socket)
+        send_failed = False
+        if connection_info is not None:
+            try:
+                connection_info.send_queue.write_to(tcp_socket)
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError as e:
+                print(e)
+                send_failed = True
+            if not send_failed:
+                self.update_client_events(connection_info)
+        self.lock.release()
+        if send_failed:
+            self.close_socket(tcp_socket)
+
+    def update_client_events(self, connection_info):
+        """
+        根据是否还有数据没发送完成来决定是否监听可写事件，调用前需要持有 self.lock
+        :param connection_info:
+        :return:
+        """
+        events = selectors.EVENT_READ
+        if len(connection_info.send_queue):
+            events |= selectors.EVENT_WRITE
+        if self.selector.get_key(connection_info.tcp_socket).events != events:
+            self.selector.modify(connection_info.tcp_socket, events, data=None)
+
+    def event_loop(self):
+        """
+        服务器的事件循环，一个线程处理监听、接收和发送
+        :return:
+        """
+        while not self.exit_event.is_set():
+            events = self.selector.select(timeout=self.select_timeout)
+            for key, mask in events:
+                if key.data == 'accept':
+                    self.accept_client()
+                elif key.data == 'wakeup':
+                    try:
+                        while self.wakeup_recv_socket.recv(self.buffer_size):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    closing_sockets = []
+                    self.lock.acquire()
+                    for connection_info in self.tcp_clients_2_connection_info.values():
+                        if connection_info.close_pending:
+                            closing_sockets.append(connection_info.tcp_socket)
+                        else:
+                            self.update_client_events(connection_info)
+                    self.lock.release()
+                    for tcp_socket in closing_sockets:
+                        try:
+                            self.close_socket(tcp_socket)
+                        except Exception as e:
+                            print('error while closing client: {!r}'.format(e))
+                            traceback.print_exc()
+                    while self.pending_calls:
+                        func = self.pending_calls.popleft()
+                        try:
+                            func()
+                        except Exception as e:
+                            print('error while running pending call: {!r}'.format(e))
+                            traceback.print_exc()
+                else:
+                    # 单个客户端的处理出现异常的时候只断开这个客户端，事件循环线程需要继续服务其他的客户端
+                    try:
+                        if mask & selectors.EVENT_READ:
+                            self.read_client(key.fileobj)
+                        if mask & selectors.EVENT_WRITE:
+                            self.write_client(key.fileobj)
+                    except Exception as e:
+                        self.close_broken_client(key.fileobj, e)
+
+    def close_broken_client(self, tcp_socket, error):
+        """
+        处理客户端数据的时候出现了异常，记录异常并断开这个客户端，会触发 SocketClose 回调
+        :param tcp_socket:
+        :param error:
+        :return:
+        """
+        print('error while serving client: {}, disconnect it: {!r}'.format(
+            getattr(self.tcp_clients_2_connection_info.get(tcp_socket), 'address', None), error))
+        traceback.print_exc()
+        try:
+            self.close_socket(tcp_socket)
+        except Exception as e:
+            print('error while closing client: {!r}'.format(e))
+
+    def process_client_frames(self, frames, tcp_socket):
+        """
+        在事件循环之外处理一个连接已经接收完整的数据帧，例如 adopt_client 返回的数据帧，
+        数据帧不符合协议的时候只断开这个连接
+        :param frames: [(data_type, data), ...]
+        :param tcp_socket:
+        :return:
+        """
+        try:
+            self.process_frames(frames, tcp_socket)
+        except ProtocolError as e:
+            self.close_broken_client(tcp_socket, e)
+
+    def bind_and_listen(self):
+        """
+        服务器进行绑定和监听，并把监听 socket 注册到事件循环中
+        :return:
+        """
+        self.is_server = True
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        self.tcp_socket.bind((self.host, self.port))
+        print('server port bind successfully, server host: {}, server port: {}...'.format(
+            self.host, self.port))
+        self.tcp_socket.listen(self.max_connections)
+        self.tcp_socket.setblocking(False)
+        self.selector.register(self.tcp_socket, selectors.EVENT_READ, data='accept')
+        print('start to listen connections from client, max client count: {}'.format(
+            self.max_connections))
+
+    def start(self, listen=True):
+        """
+        绑定端口后启动事件循环线程
+        :param listen: 是否监听端口，为 False 的时候只处理通过 adopt_client 接管的连接
+        :return:
+        """
+        if listen:
+            self.bind_and_listen()
+        self.selector.register(self.wakeup_recv_socket, selectors.EVENT_READ, data='wakeup')
+        self.event_loop_thread = threading.Thread(target=self.event_loop, daemon=True)
+        self.event_loop_thread.start()
+        print("starting server event loop...")
+
+    def detach_client(self, tcp_socket):
+        """
+        把客户端连接从事件循环中移除但是不关闭，用于把连接移交给其他进程，
+        这里不会阻塞，发送队列中还没有发送的数据会一起返回，由接管连接的一方继续发送，
+        不会触发 SocketClose 回调，需要在事件循环线程中调用
+        :param tcp_socket:
+        :return: (已经接收但是还没有解析的数据, 还没有发送的数据)，连接不存在的时候返回 None
+        """
+        self.lock.acquire()
+        connection_info = self.tcp_clients_2_connection_info.pop(tcp_socket, None)
+        if connection_info is not None:
+            self.selector.unregister(tcp_socket)
+        self.lock.release()
+        if connection_info is None:
+            return None
+        unsent_data = b''.join(data_part.tobytes() for message in connection_info.send_queue.messages
+                               for data_part in message.data_parts)
+        frame_decoder = self.frame_decoders.get(tcp_socket)
+        pending_data = frame_decoder.pending_data() if frame_decoder is not None else b''
+        self.release_frame_decoder(tcp_socket)
+        self.compression_sockets.discard(tcp_socket)
+        return pending_data, unsent_data
+
+    def adopt_client(self, tcp_socket, pending_data=b'', unsent_data=b''):
+        """
+        接管一个已经建立好的客户端连接，例如从其他进程移交过来的连接
+        :param tcp_socket:
+        :param pending_data: detach_client 返回的还没有解析的数据
+        :param unsent_data: detach_client 返回的还没有发送的数据，会在之后的所有数据之前发送
+        :return: pending_data 中已经完整的数据帧，需要由调用者交给 process_frames
+        """
+        tcp_socket.setblocking(False)
+        tcp_client_address = tcp_socket.getpeername()
+        frames = []
+        self.lock.acquire()
+        connection_info = ConnectionInfo(
+            tcp_socket, tcp_client_address, self.max_send_queue_bytes, self.slow_consumer_policy)
+        self.tcp_clients_2_connection_info[tcp_socket] = connection_info
+        if pending_data:
+            try:
+                frames = self.get_frame_decoder(tcp_socket).feed(pending_data)
+            except ProtocolError as e:
+                # 移交过来的数据不符合协议，交给事件循环断开这个连接
+                print('invalid pending data from adopted client: {}, disconnect it: {!r}'.format(
+                    tcp_client_address, e))
+                connection_info.close_pending = True
+        if unsent_data:
+            # 可能是已经发送了一部分的消息，不能被丢弃或者替换
+            connection_info.send_queue.push([unsent_data], started=True)
+        self.selector.register(tcp_socket, selectors.EVENT_READ, data=None)
+        self.lock.release()
+        if unsent_data or connection_info.close_pending:
+            self.wakeup()
+        print("client adopted, client address: {}, total client count: {}".format(
+            tcp_client_address, len(self.tcp_clients_2_connection_info)))
+        return frames
+
+    def send(self, tcp_socket, data, pack_data=False, data_type=DataType.TypeNone, coalesce_key=None):
+        """
+        向客户端发送数据，首先尝试直接发送，发送不完的部分交给事件循环继续发送
+        :param tcp_socket:
+        :param data:
+        :param pack_data:
+        :param data_type:
+        :param coalesce_key: 可以被之后相同 key 的数据替代的时候设置，客户端发送缓慢时可以被丢弃或者合并
+        :return:
+        """
+        if pack_data:
+            data_parts = self.pack_data_parts(data=data, data_type=data_type,
+                                              compress=tcp_socket in self.compression_sockets)
+        else:
+            data_parts = [data]
+        self.send_parts(tcp_socket, data_parts, coalesce_key=coalesce_key)
+
+    def send_parts(self, tcp_socket, data_parts, coalesce_key=None):
+        """
+        向客户端发送多段数据，发送队列为空的时候首先尝试用 sendmsg 直接发送，否则加入发送队列，
+        这里不会阻塞，发送缓慢的客户端只会积压自己的发送队列，超过上限之后按照 slow_consumer_policy 处理，
+        需要断开的连接由事件循环关闭
+        :param tcp_socket:
+        :param data_parts:
+        :param coalesce_key:
+        :return:
+        """
+        need_wakeup = False
+        self.lock.acquire()
+        connection_info = self.tcp_clients_2_connection_info.get(tcp_socket)
+        if connection_info is not None and not connection_info.close_pending:
+            send_queue = connection_info.send_queue
+            started = False
+            if len(send_queue) == 0:
+                try:
+                    sent_length = send_data_parts(tcp_socket, data_parts)
+                except (BlockingIOError, InterruptedError):
+                    sent_length = 0
+                except OSError as e:
+                    print(e)
+                    sent_length = 0
+                    connection_info.close_pending = True
+                started = sent_length > 0
+                data_parts = get_remaining_parts(data_parts, sent_length)
+            if not connection_info.close_pending and len(data_parts):
+                if not send_queue.push(data_parts, coalesce_key=coalesce_key, started=started):
+                    print("client: {} is too slow, send queue: {} bytes, disconnect it. ".format(
+                        connection_info.address, send_queue.queued_bytes))
+                    connection_info.close_pending = True
+                need_wakeup = True
+            need_wakeup = need_wakeup or connection_info.close_pending
+        self.lock.release()
+        if need_wakeup:
+            self.wakeup()
+
+    def broadcast(self, tcp_sockets, data, pack_data=False, data_type=DataType.TypeNone, coalesce_key=None):
+        """
+        向多个客户端发送同一份数据，数据只打包一次，所有客户端共用同一份缓存
+        :param tcp_sockets:
+        :param data:
+        :param pack_data:
+        :param data_type:
+        :param coalesce_key:
+        :return:
+        """
+        for tcp_socket, data_parts in self.pack_broadcast_parts(list(tcp_sockets), data, pack_data, data_type):
+            self.send_parts(tcp_socket, data_parts, coalesce_key=coalesce_key)
+
+    def send_all_clients(self, data, pack_data=False, data_type=DataType.TypeNone, coalesce_key=None):
+        self.broadcast(list(self.tcp_clients_2_connection_info.keys()), data,
+                       pack_data=pack_data, data_type=data_type, coalesce_key=coalesce_key)
 
 
 class TcpClientTools(TcpBaseTools):
@@ -394,7 +1149,7 @@ class TcpClientTools(TcpBaseTools):
         while not close_event.is_set():
             try:
                 if tcp_socket:
-                    recv_data = tcp_socket.recv(self.buffer_size)
+                    recv_length, frames = self.recv_frames(tcp_socket)
                 else:
                     Warning('the tcp_client is not available, skipping client process! ')
                     break
@@ -406,7 +1161,7 @@ class TcpClientTools(TcpBaseTools):
             # ----------------------------------------------------------------
             # recv_data = tcp_socket.recv(self.buffer_size)
             # 这个指的是客户端发来的断开连接的消息
-            if recv_data == b'':
+            if recv_length == 0:
                 self.exit_event.set()
                 # 针对客户端，这俩应该是一致的
                 # 此处应该编写挥手指令
@@ -422,7 +1177,10 @@ class TcpClientTools(TcpBaseTools):
                 continue
 
             # 另外编写函数处理对应的内容
-            self.process_raw_data(recv_data, tcp_socket)
+            try:
+                self.process_frames(frames, tcp_socket)
+            except ProtocolError as e:
+                self.shutdown_broken_socket(tcp_socket, e)
 
     def connect_to_server(self, host, port):
         """
@@ -457,7 +1215,8 @@ class TcpClientTools(TcpBaseTools):
         :return:
         """
         if pack_data:
-            data = self.pack_data(data=data, data_type=data_type)
+            data = self.pack_data(data=data, data_type=data_type,
+                                  compress=self.tcp_socket in self.compression_sockets)
         try:
             if self.connect_state:
                 self.tcp_socket.send(data)
@@ -126,6 +126,9 @@ class AirPlaneParams:
 
 
 class AirPlane(DynamicObject, Building):
+    # 同一种飞机的同一个姿态帧在同一个角度下的图片和 mask 只计算一次，所有飞机共用
+    sprite_cache = rotation_cache
+
     def __init__(self, team_number, game_data):
         DynamicObject.__init__(self, team_number, game_data)
         Building.__init__(self, team_number, game_data)
@@ -269,6 +272,58 @@ class AirPlane(DynamicObject, Building):
     def set_image_template(self, image_template):
         self.image_template = image_template
 
+    def capture_state(self):
+        """
+        保存飞机在 fixed_update 中会发生变化的所有逻辑状态，用于本地预测和回滚，
+        渲染预测状态的时候 get_sprite 会改变图片、mask 和碰撞矩形的大小，这些也需要一起保存
+        :return:
+        """
+        return {'position': np.array(self._position, copy=True),
+                'direction_vector': np.array(self._direction_vector, copy=True),
+                'velocity': self.velocity,
+                'angular_velocity': self.angular_velocity,
+                'roll_attitude': self.roll_attitude,
+                'pitch_attitude': self.pitch_attitude,
+                'timer_counter': self.timer_counter,
+                'switch_direction': self.switch_direction,
+                'engine_temperature': self._engine_temperature,
+                'heat_counter': self.heat_counter,
+                'engine_heat_rate': self._air_plane_params.engine_heat_rate,
+                'primary_weapon_reload_counter': self.primary_weapon_reload_counter,
+                'secondary_weapon_reload_counter': self.secondary_weapon_reload_counter,
+                'score': self.score,
+                'input_state': self.input_state,
+                'rect_position': (self.rect.x, self.rect.y),
+                'rect_size': (self.rect.width, self.rect.height),
+                'image': self.image,
+                'mask': self.mask}
+
+    def restore_state(self, state):
+        """
+        恢复 capture_state 保存的状态，包括精灵图片、mask 和碰撞矩形的大小
+        :param state:
+        :return:
+        """
+        self._position = np.array(state['position'], copy=True)
+        self._direction_vector = np.array(state['direction_vector'], copy=True)
+        self.velocity = state['velocity']
+        self.angular_velocity = state['angular_velocity']
+        self.roll_attitude = state['roll_attitude']
+        self.pitch_attitude = state['pitch_attitude']
+        self.timer_counter = state['timer_counter']
+        self.switch_direction = state['switch_direction']
+        self._engine_temperature = state['engine_temperature']
+        self.heat_counter = state['heat_counter']
+        self._air_plane_params.engine_heat_rate = state['engine_heat_rate']
+        self.primary_weapon_reload_counter = state['primary_weapon_reload_counter']
+        self.secondary_weapon_reload_counter = state['secondary_weapon_reload_counter']
+        self.score = state['score']
+        self.input_state = state['input_state']
+        self.rect.x, self.rect.y = state['rect_position']
+        self.rect.width, self.rect.height = state['rect_size']
+        self.image = state['image']
+        self.mask = state['mask']
+
     def get_air_plane_params(self):
         return self._air_plane_params
 
@@ -292,15 +347,17 @@ class AirPlane(DynamicObject, Building):
         else:
             rect_dic = self.air_plane_sprites.roll_mapping[int(0)]
 
-        self.image = get_rect_sprite((rect_dic, self.image_template))
-        self.image = pygame.transform.rotate(
-            self.image, vector_2_angle(self.get_direction_vector()))
+        source_key = (self._air_plane_params.name,
+                      rect_dic['x'], rect_dic['y'], rect_dic['width'], rect_dic['height'])
+        self.image, mask = self.sprite_cache.get_rotated(
+            source_key, vector_2_angle(self.get_direction_vector()),
+            lambda: get_rect_sprite((rect_dic, self.image_template)))
         # 在飞行姿势大于30度的时候不可被击中
         if 0 <= self.pitch_attitude <= 3 or 33 <= self.pitch_attitude <= 36:
             rect = self.image.get_rect()
             self.rect.width = rect.width
             self.rect.height = rect.height
-            self.mask = pygame.mask.from_surface(self.image)
+            self.mask = mask
         else:
             # 此处设置为 1 主要为了和没设置时的 0 区分
             self.rect.width = 1
@@ -524,12 +581,10 @@ class AirPlane(DynamicObject, Building):
         self.input_state = InputState.NoInput
         # 需要来一个偷梁换柱
         real_velocity = self.velocity
-        self.velocity *= np.cos(np.radians(self.pitch_attitude * 10))
-        pos, direction_vector = self.move(delta_time=delta_time)
-        self.velocity = real_velocity
+        self.velocity *= self.get_cos(self.pitch_attitude * 10)
         # 物理更新直接改变数值内容
-        self.set_direction_vector(direction_vector)
-        self.set_position(pos)
+        self.update_motion(delta_time=delta_time)
+        self.velocity = real_velocity
 
     def take_damage(self, damage):
         self.score -= damage * 0.5
@@ -549,11 +604,11 @@ class AirPlane(DynamicObject, Building):
 
     def create_bullet(self, bullet_sprite, local_position, direction):
         # direction = np.array([-direction[1], direction[0]])
-        new_bullet = Bullet(self.team_number, self.game_data)
+        new_bullet = self.game_data.bullet_pool.acquire(Bullet, self.team_number, self.game_data)
         new_bullet.set_map_size(self.get_map_size())
-        new_bullet.set_sprite(pygame.transform.rotate(
+        new_bullet.set_sprite(*rotation_cache.get_rotated_surface(
             bullet_sprite, vector_2_angle(self.get_direction_vector())))
-        local_position[1] = np.cos(np.radians(self.roll_attitude * 10)) * local_position[1]
+        local_position[1] = self.get_cos(self.roll_attitude * 10) * local_position[1]
         new_bullet.set_position(local_to_world(
             self.get_position(), direction, local_point=local_position))
         new_bullet.set_speed(self.velocity + 5)
@@ -564,11 +619,11 @@ class AirPlane(DynamicObject, Building):
 
     def create_bomb(self, bomb_sprite, local_position, direction):
         # direction = np.array([-direction[1], direction[0]])
-        new_bullet = Bullet(self.team_number, self.game_data)
+        new_bullet = self.game_data.bullet_pool.acquire(Bullet, self.team_number, self.game_data)
         new_bullet.set_map_size(self.get_map_size())
-        new_bullet.set_sprite(pygame.transform.rotate(
+        new_bullet.set_sprite(*rotation_cache.get_rotated_surface(
             bomb_sprite, vector_2_angle(self.get_direction_vector())))
-        local_position[1] = np.cos(np.radians(self.roll_attitude * 10)) * local_position[1]
+        local_position[1] = self.get_cos(self.roll_attitude * 10) * local_position[1]
         new_bullet.set_position(local_to_world(
             self.get_position(), direction, local_point=local_position))
         new_bullet.set_speed(self.velocity + 2)
@@ -579,11 +634,11 @@ class AirPlane(DynamicObject, Building):
 
     def create_RKT(self, RKT_sprite, local_position, direction):
         # direction = np.array([-direction[1], direction[0]])
-        new_bullet = Bullet(self.team_number, self.game_data)
+        new_bullet = self.game_data.bullet_pool.acquire(Bullet, self.team_number, self.game_data)
         new_bullet.set_map_size(self.get_map_size())
-        new_bullet.set_sprite(pygame.transform.rotate(
+        new_bullet.set_sprite(*rotation_cache.get_rotated_surface(
             RKT_sprite, vector_2_angle(self.get_direction_vector())))
-        local_position[1] = np.cos(np.radians(self.roll_attitude * 10)) * local_position[1]
+        local_position[1] = self.get_cos(self.roll_attitude * 10) * local_position[1]
         new_bullet.set_position(local_to_world(
             self.get_position(), direction, local_point=local_position))
         new_bullet.set_speed(self.velocity + 4)
@@ -594,11 +649,11 @@ class AirPlane(DynamicObject, Building):
 
     def create_AAM(self, aam_sprite, local_position, direction, target):
         # direction = np.array([-direction[1], direction[0]])
-        new_aam = AAM(self.team_number, self.game_data)
+        new_aam = self.game_data.bullet_pool.acquire(AAM, self.team_number, self.game_data)
         new_aam.set_map_size(self.get_map_size())
         # 由于此处的sprite会自己变化，所以应该给的是初始的姿态的 sprite
-        new_aam.set_sprite(aam_sprite)
-        local_position[1] = np.cos(np.radians(self.roll_attitude * 10)) * local_position[1]
+        new_aam.set_sprite(*rotation_cache.get_rotated_surface(aam_sprite, 0))
+        local_position[1] = self.get_cos(self.roll_attitude * 10) * local_position[1]
         new_aam.set_position(local_to_world(
             self.get_position(), direction, local_point=local_position))
         new_aam.set_speed(self.velocity + 4)
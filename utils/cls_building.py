@@ -143,7 +143,7 @@ class Turret(DynamicObject, Building):
         # ----------------------------------------------------------------
         # 此处需要考虑资源释放问题
         if self.durability > 0:
-            rotated_cannon = pygame.transform.rotate(
+            rotated_cannon, _ = rotation_cache.get_rotated_surface(
                 self.cannon_sprite, vector_2_angle(self.get_direction_vector()))
             return self.body_sprite, rotated_cannon
         else:
@@ -155,9 +155,10 @@ class Turret(DynamicObject, Building):
         :return: 返回创建的子弹
         """
         # direction = np.array([-direction[1], direction[0]])
-        new_bullet = Bullet(self.team_number, self.game_data)
+        new_bullet = self.game_data.bullet_pool.acquire(Bullet, self.team_number, self.game_data)
         new_bullet.set_map_size(self.get_map_size())
-        new_bullet.set_sprite(pygame.transform.rotate(self.bullet_sprite, vector_2_angle(self._direction_vector)))
+        new_bullet.set_sprite(*rotation_cache.get_rotated_surface(
+            self.bullet_sprite, vector_2_angle(self._direction_vector)))
         new_bullet.set_position(local_to_world(
             self.get_position(), self._direction_vector, local_point=local_position))
         new_bullet.set_speed(self.velocity + self.bullet_velocity)
@@ -220,9 +221,7 @@ class Flak(Turret):
                                              * np.sign(cross_result))[0]
                 else:
                     self.angular_velocity = 0
-                pos, direction_vector = self.move(delta_time=delta_time)
-                self.set_position(pos)
-                self.set_direction_vector(direction_vector)
+                self.update_motion(delta_time=delta_time)
 
                 # 如果实际炮塔角度和理想角度比较接近的话就可以开火了
                 vector_angle_cos = float(np.dot(self.get_direction_vector().T, lead_target_position))
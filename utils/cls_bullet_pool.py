@@ -0,0 +1,38 @@
+class BulletPool:
+    """
+    子弹的对象池：爆炸之后的子弹放回池中，发射的时候优先复用，不再每次都创建新的 Sprite，
+    旋转之后的子弹图片和 mask 由 cls_obj.rotation_cache 缓存
+    """
+    def __init__(self):
+        self.free_bullets = {}          # {子弹的类: [空闲的子弹, ...]}
+        self.created_count = 0
+        self.reused_count = 0
+
+    def acquire(self, bullet_class, team_number, game_data):
+        """
+        获取一个子弹，池中有空闲的子弹时重置之后复用，否则创建新的子弹
+        :param bullet_class: Bullet 或者它的子类
+        :param team_number:
+        :param game_data:
+        :return:
+        """
+        free_bullets = self.free_bullets.get(bullet_class)
+        if free_bullets:
+            bullet = free_bullets.pop()
+            bullet.reset(team_number, game_data)
+            self.reused_count += 1
+            return bullet
+        self.created_count += 1
+        return bullet_class(team_number, game_data)
+
+    def release(self, bullet):
+        """
+        子弹从游戏中移除之后放回池中，重复放回会被忽略
+        :param bullet:
+        :return:
+        """
+        if bullet.is_pooled:
+            return
+        bullet.is_pooled = True
+        bullet.release_entity()
+        self.free_bullets.setdefault(type(bullet), []).append(bullet)
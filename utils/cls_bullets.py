@@ -1,17 +1,48 @@
 import numpy as np
 
-from utils.cls_obj import DynamicObject, get_rect_sprite, vector_2_angle
+from utils.cls_obj import DynamicObject, entity_field_property, get_rect_sprite, rotation_cache, vector_2_angle
 import pygame
 
 
 
 class Bullet(DynamicObject):
+    _damage = entity_field_property('damage')
+    time_passed = entity_field_property('time_passed')
+    expired_time = entity_field_property('expired_time')
+
     def __init__(self, team_number, game_data):
         super().__init__(team_number, game_data)
         self._damage = 0
         self.expired_time = 2000
         self.time_passed = 0
         self.parent = None
+        self.is_pooled = False  # 是否已经放回了对象池
+
+    def reset(self, team_number, game_data):
+        """
+        从对象池中复用的时候重置为刚创建时的状态，不重新创建 Sprite、Rect 等对象
+        :param team_number:
+        :param game_data:
+        :return:
+        """
+        self.game_data = game_data
+        self.mask = None
+        self.rect.update(0, 0, 0, 0)
+        self.image = None
+        self.collision_box = None
+        self.team_number = team_number
+        self._map_size = np.array([0, 0])
+        self._position = (0, 0)
+        self._direction_vector = (1, 0)
+        self.speed = 0.0
+        self.velocity = 0
+        self.angular_speed = 0
+        self.angular_velocity = 0
+        self._damage = 0
+        self.expired_time = 2000
+        self.time_passed = 0
+        self.parent = None
+        self.is_pooled = False
 
     def is_bullet_expired(self):
         return self.time_passed >= self.expired_time
@@ -20,12 +51,17 @@ class Bullet(DynamicObject):
         return self.image
 
     def explode(self, target):
+        if self.is_pooled:
+            # 已经爆炸过了
+            return False
         self.parent.bullet_group.remove(self)
-        # 释放自身资源
+        damage = self._damage
+        # 释放自身资源，放回对象池
         self.on_death()
+        self.game_data.bullet_pool.release(self)
         # 返回真表示攻击目标已死亡，假表示未死亡
         if target is not None:
-            return target.take_damage(self._damage)
+            return target.take_damage(damage)
         else:
             return False
 
@@ -53,6 +89,45 @@ class Bullet(DynamicObject):
         self._damage = damage
 
 
+def update_bullet_group(bullet_group, entity_store, map_size, delta_time):
+    """
+    批量更新一组子弹：直线飞行的子弹在 EntityStore 上用一次 numpy 运算完成移动、地图循环和生命周期检测，
+    重写了 fixed_update 的子弹（例如会转向的追踪导弹）仍然逐个调用 fixed_update。
+    计算的顺序和 Bullet.fixed_update 完全一致，结果逐位相同
+    :param bullet_group: 子弹的 pygame.sprite.Group
+    :param entity_store: 子弹所在的 EntityStore
+    :param map_size: 地图大小
+    :param delta_time:
+    :return:
+    """
+    bullets = []
+    for bullet in bullet_group:
+        if type(bullet).fixed_update is Bullet.fixed_update and bullet.entity_store is entity_store:
+            bullets.append(bullet)
+        else:
+            bullet.fixed_update(delta_time=delta_time)
+    if not bullets:
+        return
+    slots = np.array([bullet.entity_slot for bullet in bullets])
+    entity_store.time_passed[slots] += delta_time
+    # 和 DynamicObject.move 一致：int(velocity * delta_time * 0.1) * (direction * [1, -1])
+    distance = np.trunc(entity_store.velocity[slots] * delta_time * 0.1)
+    position = entity_store.position[slots] + distance[:, np.newaxis] * (entity_store.direction[slots] * [1, -1])
+    position = np.mod(position, map_size)
+    entity_store.position[slots] = position
+    expired = entity_store.time_passed[slots] >= entity_store.expired_time[slots]
+    for bullet, (x, y), is_expired in zip(bullets, position, expired):
+        # 和 StaticObject.set_position 一致地更新碰撞检测使用的 rect
+        bullet.rect.x = x - 0.5 * bullet.rect.width
+        bullet.rect.y = y - 0.5 * bullet.rect.height
+        if bullet.rect.x < 0:
+            bullet.rect.x += map_size[0]
+        if bullet.rect.y < 0:
+            bullet.rect.y += map_size[1]
+        if is_expired:
+            bullet.explode(None)
+
+
 class RKT(Bullet):
     """
     火箭弹，主要用于对地攻击
@@ -76,12 +151,20 @@ class AAM(RKT):
         self.expired_time = 4000
         self.angle_threshold = 0.5
 
+    def reset(self, team_number, game_data):
+        super().reset(team_number, game_data)
+        self.target_object = None
+        self.angular_speed = 1.5
+        self._damage = 200
+        self.expired_time = 4000
+        self.angle_threshold = 0.5
+
     def get_sprite(self):
         """
         追踪导弹在发射出去后需要转向，因此模型贴图需要更新
         :return:
         """
-        tmp_image = pygame.transform.rotate(
+        tmp_image, _ = rotation_cache.get_rotated_surface(
             self.image, vector_2_angle(self.get_direction_vector()))
 
         return tmp_image
@@ -115,9 +198,7 @@ class AAM(RKT):
                     self.target_object = None
 
             # 如果没有目标，仍然要向前进
-            pos, direction_vector = self.move(delta_time=delta_time)
-            self.set_position(pos)
-            self.set_direction_vector(direction_vector)
+            self.update_motion(delta_time=delta_time)
 
 
 
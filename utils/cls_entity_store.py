@@ -0,0 +1,98 @@
+import numpy as np
+
+# 每个 slot 保存的数据，alive 只表示 slot 的使用状态，不属于物体的数据
+entity_fields = ('position', 'direction', 'speed', 'velocity', 'angular_speed', 'angular_velocity',
+                 'team', 'damage', 'time_passed', 'expired_time', 'heading')
+
+
+class EntityStore:
+    """
+    游戏中可以移动的物体（飞机、子弹、炮台）的数据按照列存储（structure of arrays），
+    每个物体占用其中的一行（slot），物体本身只保存自己的 slot，位置、方向、速度等数据都是这里的数组的视图，
+    这样整个世界的物理运算可以对整列数据一次完成，不需要逐个物体计算
+    """
+    def __init__(self, capacity=256):
+        """
+        :param capacity: 初始的容量，不够的时候自动扩容为原来的两倍
+        """
+        self.capacity = 0
+        self.position = np.zeros((0, 2))            # 位置 [x, y]
+        self.direction = np.zeros((0, 2))           # 方向向量 [x, y]
+        self.speed = np.zeros((0,))                 # 正常运行速度
+        self.velocity = np.zeros((0,))              # 当前速度
+        self.angular_speed = np.zeros((0,))         # 转向速度
+        self.angular_velocity = np.zeros((0,))      # 当前的转向速度
+        self.team = np.zeros((0,), dtype=np.int16)
+        self.damage = np.zeros((0,))                # 子弹的伤害
+        self.time_passed = np.zeros((0,))           # 子弹已经飞行的时间
+        self.expired_time = np.zeros((0,))          # 子弹的生命周期
+        self.heading = np.zeros((0,), dtype=np.int64)  # 定点数模式下的整数角度，见 cls_fixed_point
+        self.alive = np.zeros((0,), dtype=bool)     # slot 是否正在被使用
+        self.use_fixed_point = False                # 是否使用定点数的运动学计算
+        self.free_slots = []
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        """
+        扩容，已有的数据保持不变，新的 slot 都是空闲的
+        :param capacity: 新的容量
+        :return:
+        """
+        for name in entity_fields + ('alive',):
+            array = getattr(self, name)
+            new_array = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            new_array[:self.capacity] = array
+            setattr(self, name, new_array)
+        # 倒序放入，保证先分配编号小的 slot
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    def allocate(self):
+        """
+        分配一个 slot，数据初始化为默认值
+        :return: slot
+        """
+        if not self.free_slots:
+            self.grow(max(self.capacity * 2, 1))
+        slot = self.free_slots.pop()
+        self.position[slot] = 0
+        self.direction[slot] = (1, 0)
+        self.speed[slot] = 0
+        self.velocity[slot] = 0
+        self.angular_speed[slot] = 0
+        self.angular_velocity[slot] = 0
+        self.team[slot] = 0
+        self.damage[slot] = 0
+        self.time_passed[slot] = 0
+        self.expired_time[slot] = 0
+        self.heading[slot] = 0
+        self.alive[slot] = True
+        return slot
+
+    def release(self, slot):
+        """
+        释放 slot，重复释放会被忽略
+        :param slot:
+        :return:
+        """
+        if not self.alive[slot]:
+            return
+        self.alive[slot] = False
+        self.free_slots.append(slot)
+
+    def copy_slot(self, source_store, source_slot, slot):
+        """
+        把另一个 EntityStore 中的一行数据复制到 slot
+        :param source_store:
+        :param source_slot:
+        :param slot:
+        :return:
+        """
+        for name in entity_fields:
+            getattr(self, name)[slot] = getattr(source_store, name)[source_slot]
+
+    def get_alive_slots(self):
+        return np.flatnonzero(self.alive)
+
+    def __len__(self):
+        return self.capacity - len(self.free_slots)
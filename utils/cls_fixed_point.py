@@ -0,0 +1,131 @@
+"""
+定点数物理模式使用的整数角度和三角函数表：
+一圈为 65536 个角度单位，sin/cos 使用 Q14 定点数（乘以 16384 之后的整数）表示，
+三角函数表只用 python 的整数运算生成，不依赖平台的 libm，所有客户端得到完全相同的表
+"""
+
+ANGLE_UNITS = 65536                 # 一圈的角度单位数
+QUARTER_UNITS = ANGLE_UNITS // 4
+QUARTER_SHIFT = QUARTER_UNITS.bit_length() - 1   # 整数角度右移 QUARTER_SHIFT 位得到象限
+ANGLE_MASK = ANGLE_UNITS - 1
+FIXED_SHIFT = 14
+FIXED_ONE = 1 << FIXED_SHIFT        # Q14 的 1.0，位置也按照 1 / FIXED_ONE 像素量化
+
+_sin_table = None                   # 第一象限的 sin 表，下标为 0 - QUARTER_UNITS
+
+
+def _get_atan_inverse(n, one):
+    """
+    整数运算计算 atan(1 / n) * one
+    """
+    term = one // n
+    total = term
+    n_square = n * n
+    divisor = 3
+    sign = -1
+    while term:
+        term //= n_square
+        total += sign * (term // divisor)
+        sign = -sign
+        divisor += 2
+    return total
+
+
+def _build_sin_table():
+    """
+    用整数泰勒级数生成第一象限的 Q14 sin 表
+    :return:
+    """
+    scale_bits = 80
+    one = 1 << scale_bits
+    # Machin 公式：pi = 16 * atan(1/5) - 4 * atan(1/239)
+    pi = 16 * _get_atan_inverse(5, one) - 4 * _get_atan_inverse(239, one)
+    table = []
+    for units in range(QUARTER_UNITS + 1):
+        theta = pi * units // (ANGLE_UNITS // 2)
+        theta_square = theta * theta >> scale_bits
+        term = theta
+        total = theta
+        n = 1
+        while term:
+            term = term * theta_square >> scale_bits
+            term //= (2 * n) * (2 * n + 1)
+            total += -term if n % 2 else term
+            n += 1
+        table.append((total * FIXED_ONE + (one >> 1)) >> scale_bits)
+    return table
+
+
+def get_sin_table():
+    global _sin_table
+    if _sin_table is None:
+        _sin_table = _build_sin_table()
+    return _sin_table
+
+
+def sin_q14(units):
+    """
+    :param units: 整数角度
+    :return: sin 的 Q14 整数
+    """
+    table = get_sin_table()
+    units &= ANGLE_MASK
+    quadrant, offset = units >> QUARTER_SHIFT, units & (QUARTER_UNITS - 1)
+    if quadrant == 0:
+        return table[offset]
+    elif quadrant == 1:
+        return table[QUARTER_UNITS - offset]
+    elif quadrant == 2:
+        return -table[offset]
+    else:
+        return -table[QUARTER_UNITS - offset]
+
+
+def cos_q14(units):
+    return sin_q14(units + QUARTER_UNITS)
+
+
+def degrees_to_angle_units(angle):
+    """
+    角度（度）转换为整数角度，四舍五入
+    """
+    return int(round(angle * ANGLE_UNITS / 360))
+
+
+def angle_units_to_vector(units):
+    """
+    整数角度对应的方向向量，分量都是 1 / FIXED_ONE 的整数倍
+    :return: (x, y)
+    """
+    return cos_q14(units) / FIXED_ONE, sin_q14(units) / FIXED_ONE
+
+
+def vector_to_angle_units(x, y):
+    """
+    方向向量转换为整数角度，只使用比较，不使用 atan2，
+    对于 angle_units_to_vector 得到的向量可以精确的还原出原来的角度
+    :param x:
+    :param y:
+    :return:
+    """
+    if x == 0 and y == 0:
+        return 0
+    # 先旋转到第一象限
+    if x > 0 and y >= 0:
+        quadrant = 0
+    elif x <= 0 and y > 0:
+        quadrant, x, y = 1, y, -x
+    elif x < 0 and y <= 0:
+        quadrant, x, y = 2, -x, -y
+    else:
+        quadrant, x, y = 3, -y, x
+    table = get_sin_table()
+    # 二分查找最大的 k，满足 tan(k) <= y / x，即 sin(k) * x <= cos(k) * y
+    low, high = 0, QUARTER_UNITS
+    while low < high:
+        middle = (low + high + 1) // 2
+        if table[middle] * x <= table[QUARTER_UNITS - middle] * y:
+            low = middle
+        else:
+            high = middle - 1
+    return (quadrant * QUARTER_UNITS + low) & ANGLE_MASK
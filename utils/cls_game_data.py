@@ -10,8 +10,12 @@ import os
 from enum import Enum
 import xml.etree.ElementTree as ET
 from typing import Dict, List
+from utils.GameProtocolTools import CommandType
 from utils.cls_airplane import *
 from utils.cls_building import *
+from utils.cls_bullet_pool import BulletPool
+from utils.cls_entity_store import EntityStore
+from utils.cls_spatial_hash import SpatialHash
 
 def setup_logging(log_file_path):
     """
@@ -61,16 +65,6 @@ class PlaneType(Enum):
     Reconnaissance = 4              # 侦察机（侦察视野）
     MultiRoleCombatAircraft = 5     # 多用途飞机
 
-class CommandType(Enum):
-    cmd_none = 0
-    cmd_login = 1
-    cmd_login_resp = 2
-    cmd_matching_successful = 3
-    cmd_player_action = 4
-    cmd_frame_update = 5
-    cmd_matching_state_change = 6
-    cmd_game_over = 7
-
 class PlaneName(Enum):
     Ar234 = 'Ar234'
     B17 = 'B17'
@@ -129,6 +123,8 @@ class GameResources:
         self.temporary_sprite = None
         self.thumbnail_map_sprite = None
         self.cross_hair_sprite = None
+        self.weapon_sprites = {}  # 每种子弹只裁剪一次，同一种武器共用一张图片，旋转缓存也可以共用
+        self.turret_sprites = {}  # 每种炮台的炮管和底座只裁剪一次，所有炮台共用炮管图片的旋转缓存
 
         self.load_all()
 
@@ -298,6 +294,16 @@ class GameResources:
 
         return self.temporary_sub_textures[bullet_key], self.temporary_sprite
 
+    def get_weapon_sprite(self, bullet_key='bullet1'):
+        """
+        获取裁剪好的子弹图片，同一种子弹返回同一张图片
+        :param bullet_key: bullet1 - bullet6, bomb1 - bomb5
+        :return:
+        """
+        if bullet_key not in self.weapon_sprites:
+            self.weapon_sprites[bullet_key] = get_rect_sprite(self.get_bullet_sprite(bullet_key))
+        return self.weapon_sprites[bullet_key]
+
     def get_turret_sprite(self, bullet_key='turret'):
         """
         加载炮管的精灵，参数为子弹的键
@@ -429,13 +435,14 @@ class GameResources:
     def get_flak(self, team_number, game_data):
         new_flak = Flak(team_number, game_data)
 
-        new_flak.set_turret_sprites(
-            get_rect_sprite(self.get_turret_sprite('turret0')),
-            get_rect_sprite(self.get_building_sprite('flak1', 'body')),
-            get_rect_sprite(self.get_building_sprite('flak1', 'body'))
-        )
-        new_flak.set_bullet_sprite(
-            get_rect_sprite(self.get_bullet_sprite('bullet2')))
+        if 'flak1' not in self.turret_sprites:
+            self.turret_sprites['flak1'] = (
+                get_rect_sprite(self.get_turret_sprite('turret0')),
+                get_rect_sprite(self.get_building_sprite('flak1', 'body')),
+                get_rect_sprite(self.get_building_sprite('flak1', 'body'))
+            )
+        new_flak.set_turret_sprites(*self.turret_sprites['flak1'])
+        new_flak.set_bullet_sprite(self.get_weapon_sprite('bullet2'))
         # explode_sub_textures, explode_sprite = self.get_explode_animation('explode05')
         explode_animation = self.get_explode_animation('explode05')
         new_flak.explode_sub_textures = explode_animation[0]
@@ -515,6 +522,14 @@ class GameData:
         self.id_plane_mapping: Dict[int, AirPlane] = {}
         # 渲染变量，爆炸无队伍区分
         self.list_explodes = []
+        # 飞机、子弹和炮台的位置、方向、速度等数据，按列连续存储
+        self.entity_store = EntityStore()
+        self.use_fixed_point = False
+        # 爆炸之后的子弹放回对象池，发射的时候复用
+        self.bullet_pool = BulletPool()
+        # 子弹碰撞检测的粗筛，每个物理帧开始的时候重建，键为碰撞分组
+        self.use_spatial_hash = True
+        self.spatial_hashes = {}
 
     def add_team_airplanes(self, team_number, airplane):
         airplane.team_number = team_number
@@ -609,6 +624,33 @@ class GameData:
         else:
             print('wrong team number! ')
 
+    def rebuild_spatial_hashes(self, map_size):
+        """
+        根据所有碰撞分组中物体当前的位置重建空间哈希，每个物理帧开始的时候调用一次
+        :param map_size:
+        :return:
+        """
+        self.spatial_hashes = {}
+        if not self.use_spatial_hash:
+            return
+        for collision_group in (self.team1_air_collision_group, self.team1_ground_collision_group,
+                                self.team2_air_collision_group, self.team2_ground_collision_group):
+            spatial_hash = SpatialHash()
+            spatial_hash.rebuild(collision_group, map_size)
+            self.spatial_hashes[collision_group] = spatial_hash
+
+    def get_crashed_group(self, bullet_group, collision_group):
+        """
+        计算子弹和碰撞分组的碰撞，有空间哈希的时候只比较附近的物体
+        :param bullet_group:
+        :param collision_group:
+        :return: {bullet: [target, ...]}
+        """
+        spatial_hash = self.spatial_hashes.get(collision_group)
+        if spatial_hash is not None:
+            return spatial_hash.collide_group(bullet_group)
+        return pygame.sprite.groupcollide(bullet_group, collision_group, False, False)
+
     def get_air_crashed_group(self, bullet_group, team_number):
         """
         计算对应的碰撞分组
@@ -618,11 +660,9 @@ class GameData:
         """
         crashed = {}
         if team_number == 1:
-            crashed = pygame.sprite.groupcollide(
-                bullet_group, self.team2_air_collision_group, False, False)
+            crashed = self.get_crashed_group(bullet_group, self.team2_air_collision_group)
         elif team_number == 2:
-            crashed = pygame.sprite.groupcollide(
-                bullet_group, self.team1_air_collision_group, False, False)
+            crashed = self.get_crashed_group(bullet_group, self.team1_air_collision_group)
         else:
             print('wrong team number! ')
 
@@ -637,15 +677,46 @@ class GameData:
         """
         crashed = {}
         if team_number == 1:
-            crashed = pygame.sprite.groupcollide(
-                bullet_group, self.team2_ground_collision_group, False, False)
+            crashed = self.get_crashed_group(bullet_group, self.team2_ground_collision_group)
         elif team_number == 2:
-            crashed = pygame.sprite.groupcollide(
-                bullet_group, self.team1_ground_collision_group, False, False)
+            crashed = self.get_crashed_group(bullet_group, self.team1_ground_collision_group)
         else:
             print('wrong team number! ')
 
         return crashed
 
+    def get_state_hash(self, previous_hash=0, position_scale=16, direction_scale=4096):
+        """
+        计算世界状态的滚动哈希，用于在线检测不同步：
+        飞机和炮台的位置、方向、耐久度和子弹数量，建筑的耐久度，先量化为整数，再和上一帧的哈希一起计算 crc32，
+        某一帧出现不同步之后，之后所有帧的哈希都会不同
+        :param previous_hash: 上一帧的哈希
+        :param position_scale: 位置的量化精度，1 / position_scale 像素
+        :param direction_scale: 方向向量的量化精度
+        :return: uint32 的哈希
+        """
+        values = []
+        for obj in (self.team1_airplanes + self.team2_airplanes +
+                    self.team1_turrets + self.team2_turrets):
+            position = obj.get_position().ravel()
+            direction = obj.get_direction_vector().ravel()
+            values.extend((round(position[0] * position_scale), round(position[1] * position_scale),
+                           round(direction[0] * direction_scale), round(direction[1] * direction_scale),
+                           round(obj.durability * position_scale), len(obj.bullet_group)))
+        for building in self.team1_buildings + self.team2_buildings:
+            values.append(round(building.durability * position_scale))
+        return zlib.crc32(np.array(values, dtype=np.int64).tobytes(), previous_hash)
+
+    def set_fixed_point(self, use_fixed_point):
+        """
+        开启或者关闭定点数物理模式，房间内所有客户端的设置必须相同
+        :param use_fixed_point:
+        :return:
+        """
+        self.use_fixed_point = use_fixed_point
+        self.entity_store.use_fixed_point = use_fixed_point
+
     def reset_game_data(self):
+        use_fixed_point = self.use_fixed_point
         self.__init__()
+        self.set_fixed_point(use_fixed_point)
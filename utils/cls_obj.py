@@ -1,7 +1,13 @@
+import math
 from abc import abstractmethod
+from collections import OrderedDict
+
 import numpy as np
 import pygame
 
+from utils.cls_entity_store import EntityStore
+from utils.cls_fixed_point import (ANGLE_MASK, FIXED_ONE, angle_units_to_vector, cos_q14, degrees_to_angle_units,
+                                   sin_q14, vector_to_angle_units)
 from utils.cls_game_data import GameData
 
 
@@ -64,6 +70,138 @@ def get_rect_sprite(params):
 #         return original_image
 
 
+class TrigTable:
+    """
+    角度（度）到 cos/sin 的查找表，每个角度只用 math.cos/math.sin 计算一次，结果和直接计算完全相同。
+    逻辑帧中的转向角度只由转向速度和固定的 delta_time 决定，取值很少，几乎总是命中
+    """
+    def __init__(self, max_entries=4096):
+        """
+        :param max_entries: 最多缓存的角度数量，超过之后清空重新缓存（渲染的 delta_time 不固定）
+        """
+        self.max_entries = max_entries
+        self.entries = {}
+
+    def get_cos_sin(self, angle):
+        """
+        :param angle: 角度（度）
+        :return: (cos, sin)
+        """
+        entry = self.entries.get(angle)
+        if entry is None:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+            radians = math.radians(angle)
+            entry = (math.cos(radians), math.sin(radians))
+            self.entries[angle] = entry
+        return entry
+
+    def get_cos(self, angle):
+        return self.get_cos_sin(angle)[0]
+
+
+# 所有物体共用的三角函数查找表
+trig_table = TrigTable()
+
+
+class RotationCache:
+    """
+    旋转之后的图片和 mask 的缓存，角度按照 angle_step 量化，
+    超过 max_entries 之后淘汰最久没有使用的内容（LRU）
+    """
+    def __init__(self, angle_step=2.0, max_entries=2048):
+        """
+        :param angle_step: 角度量化的步长（度）
+        :param max_entries: 最多缓存的图片数量
+        """
+        self.angle_step = angle_step
+        self.angle_bucket_count = int(round(360 / angle_step))
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # {(source_key, 量化后的角度): (image, mask, 占用的字节数)}
+        self.source_surfaces = {}       # {('surface', id): 原始图片}，保存引用防止 id 被其他图片复用
+        self.source_entry_counts = {}   # {source_key: 缓存中这张原始图片旋转之后的图片数量}
+        self.memory_bytes = 0
+        self.hit_count = 0
+        self.miss_count = 0
+
+    def get_angle_bucket(self, angle):
+        return int(round(angle / self.angle_step)) % self.angle_bucket_count
+
+    def get_rotated(self, source_key, angle, load_source):
+        """
+        获取旋转之后的图片和 mask
+        :param source_key: 原始图片的键，相同的键必须对应相同的图片
+        :param angle: 旋转的角度（度）
+        :param load_source: 没有命中的时候调用，返回原始图片
+        :return: (image, mask)
+        """
+        key = (source_key, self.get_angle_bucket(angle))
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hit_count += 1
+            self.entries.move_to_end(key)
+            return entry[0], entry[1]
+        self.miss_count += 1
+        image = pygame.transform.rotate(load_source(), key[1] * self.angle_step)
+        width, height = image.get_size()
+        # 图片的像素数据加上每个像素一位的 mask
+        entry = (image, pygame.mask.from_surface(image),
+                 width * height * image.get_bytesize() + (width * height + 7) // 8)
+        self.entries[key] = entry
+        self.memory_bytes += entry[2]
+        self.source_entry_counts[source_key] = self.source_entry_counts.get(source_key, 0) + 1
+        if len(self.entries) > self.max_entries:
+            (evicted_source_key, _), evicted_entry = self.entries.popitem(last=False)
+            self.memory_bytes -= evicted_entry[2]
+            self.source_entry_counts[evicted_source_key] -= 1
+            if self.source_entry_counts[evicted_source_key] == 0:
+                # 原始图片的所有旋转结果都被淘汰之后不再保存原始图片的引用
+                del self.source_entry_counts[evicted_source_key]
+                self.source_surfaces.pop(evicted_source_key, None)
+        return entry[0], entry[1]
+
+    def get_rotated_surface(self, surface, angle):
+        """
+        以图片本身（id）作为键获取旋转之后的图片和 mask
+        :param surface: 原始图片
+        :param angle: 旋转的角度（度）
+        :return: (image, mask)
+        """
+        source_key = ('surface', id(surface))
+        self.source_surfaces[source_key] = surface
+        return self.get_rotated(source_key, angle, lambda: surface)
+
+    def prewarm(self, surface):
+        """
+        预先计算图片在所有量化角度下旋转之后的结果，开局的时候调用，避免第一次开火的时候才计算
+        :param surface:
+        :return:
+        """
+        for angle_bucket in range(self.angle_bucket_count):
+            self.get_rotated_surface(surface, angle_bucket * self.angle_step)
+
+    def report(self, reset=True):
+        """
+        获取命中率和内存占用的统计信息
+        :param reset: 获取之后是否清零计数
+        :return:
+        """
+        total = self.hit_count + self.miss_count
+        result = {'entries': len(self.entries),
+                  'memory_kb': self.memory_bytes / 1024,
+                  'hits': self.hit_count,
+                  'misses': self.miss_count,
+                  'hit_rate': self.hit_count / total if total else 0.}
+        if reset:
+            self.hit_count = 0
+            self.miss_count = 0
+        return result
+
+
+# 所有飞机、子弹、导弹和炮管共用的旋转缓存
+rotation_cache = RotationCache(angle_step=2.0, max_entries=4096)
+
+
 class StaticObject(pygame.sprite.Sprite):
     def __init__(self, team_number, game_data):
         # 调用父类的初始化方法
@@ -83,12 +221,19 @@ class StaticObject(pygame.sprite.Sprite):
     def get_map_size(self):
         return self._map_size
 
-    def set_sprite(self, sprite):
+    def set_sprite(self, sprite, mask=None):
+        """
+        :param sprite:
+        :param mask: 已经计算好的 mask，为 None 的时候根据 sprite 重新生成
+        :return:
+        """
         rect = sprite.get_rect()
         self.rect.width = rect.width
         self.rect.height = rect.height
         self.image = sprite
-        self.mask = pygame.mask.from_surface(self.image)  # 创建记录透明点和不透明点的mask
+        if mask is None:
+            mask = pygame.mask.from_surface(self.image)  # 创建记录透明点和不透明点的mask
+        self.mask = mask
 
     def get_sprite(self):
         return self.image
@@ -144,7 +289,36 @@ class StaticObject(pygame.sprite.Sprite):
         pass
 
 
+def entity_field_property(field_name):
+    """
+    生成读写 EntityStore 中一列数据的属性，第一次访问的时候才分配 slot，
+    因为多重继承的时候 StaticObject.__init__ 可能会在 DynamicObject.__init__ 之前执行
+    :param field_name: EntityStore 中的列名
+    :return:
+    """
+    def getter(self):
+        if self.entity_store is None:
+            self.allocate_entity()
+        return getattr(self.entity_store, field_name)[self.entity_slot]
+
+    def setter(self, value):
+        if self.entity_store is None:
+            self.allocate_entity()
+        getattr(self.entity_store, field_name)[self.entity_slot] = value
+
+    return property(getter, setter)
+
+
 class DynamicObject(StaticObject):
+    # 可以移动的物体的数据保存在 GameData 的 EntityStore 中，下面的属性都是对应 slot 的视图
+    entity_store = None
+    entity_slot = None
+    speed = entity_field_property('speed')
+    velocity = entity_field_property('velocity')
+    angular_speed = entity_field_property('angular_speed')
+    angular_velocity = entity_field_property('angular_velocity')
+    team_number = entity_field_property('team')
+
     def __init__(self, team_number, game_data):
         StaticObject.__init__(self, team_number, game_data)
         self._direction_vector = np.array([1, 0]).reshape((2, 1))
@@ -153,6 +327,77 @@ class DynamicObject(StaticObject):
         self.angular_speed = 0
         self.angular_velocity = 0
 
+    def allocate_entity(self):
+        """
+        在 GameData 的 EntityStore 中分配 slot，没有 GameData 的时候使用单独的 EntityStore
+        :return:
+        """
+        entity_store = getattr(self.game_data, 'entity_store', None)
+        if entity_store is None:
+            entity_store = EntityStore(capacity=1)
+        self.entity_store = entity_store
+        self.entity_slot = entity_store.allocate()
+
+    def attach_entity_store(self, entity_store):
+        """
+        把物体的数据迁移到另一个 EntityStore 中，原来的 slot 会被释放
+        :param entity_store:
+        :return:
+        """
+        slot = entity_store.allocate()
+        if self.entity_store is not None:
+            entity_store.copy_slot(self.entity_store, self.entity_slot, slot)
+            self.entity_store.release(self.entity_slot)
+        self.entity_store = entity_store
+        self.entity_slot = slot
+
+    def release_entity(self):
+        """
+        物体从游戏中移除的时候释放 slot，之后再访问数据会重新分配 slot
+        :return:
+        """
+        if self.entity_store is not None:
+            self.entity_store.release(self.entity_slot)
+            self.entity_store = None
+            self.entity_slot = None
+
+    @property
+    def _position(self):
+        if self.entity_store is None:
+            self.allocate_entity()
+        return self.entity_store.position[self.entity_slot]
+
+    @_position.setter
+    def _position(self, vector_2d):
+        if self.entity_store is None:
+            self.allocate_entity()
+        if self.entity_store.use_fixed_point:
+            # 定点数模式下位置量化为 1 / FIXED_ONE 像素，python 的 round 和 np.round 一样是四舍六入五成双
+            x, y = np.ravel(vector_2d).tolist()
+            vector_2d = (round(x * FIXED_ONE) / FIXED_ONE, round(y * FIXED_ONE) / FIXED_ONE)
+        self.entity_store.position[self.entity_slot] = np.ravel(vector_2d)
+
+    @property
+    def _direction_vector(self):
+        if self.entity_store is None:
+            self.allocate_entity()
+        return self.entity_store.direction[self.entity_slot].reshape((2, 1))
+
+    @_direction_vector.setter
+    def _direction_vector(self, vector_2d):
+        if self.entity_store is None:
+            self.allocate_entity()
+        if self.entity_store.use_fixed_point:
+            # 定点数模式下方向由整数角度决定，方向向量取三角函数表中的值
+            heading = vector_to_angle_units(*np.ravel(vector_2d).tolist())
+            self.entity_store.heading[self.entity_slot] = heading
+            vector_2d = angle_units_to_vector(heading)
+        self.entity_store.direction[self.entity_slot] = np.ravel(vector_2d)
+
+    def get_position(self):
+        # 返回副本，和原来每次 set_position 都替换数组一样，调用者保存的位置不会随着之后的更新变化
+        return self._position.reshape((2, 1)).copy()
+
     def set_speed(self, speed):
         self.speed = speed
         self.velocity = speed
@@ -164,33 +409,109 @@ class DynamicObject(StaticObject):
         """
         move函数并不会修改任何游戏数据，只是会根据从上一个逻辑帧出发经过的时间
         计算得到目前实例应该在的位置
+        全部使用 python 的浮点数运算，只有 IEEE 规定了舍入的加减乘除和开方，
+        不经过 BLAS 的 np.dot / np.linalg.norm（不同的 CPU 上可能使用 FMA，舍入结果不同），所有客户端的结果逐位相同
         :param delta_time:
         :return:
         """
+        if self.entity_store is None:
+            self.allocate_entity()
+        if self.entity_store.use_fixed_point:
+            return self.move_fixed_point(delta_time)
+        x, y = self.entity_store.position[self.entity_slot].tolist()
+        direction_x, direction_y = self.entity_store.direction[self.entity_slot].tolist()
         # ---------------------------------------------
         # move
-        _2d_velocity = (int(self.velocity * delta_time * 0.1) *
-                        np.multiply(self._direction_vector.reshape((2, 1)), np.array([1, -1]).reshape((2, 1))))
+        distance = int(self.velocity * delta_time * 0.1)
+        position = np.array([[x + distance * direction_x], [y - distance * direction_y]])
 
         # ---------------------------------------------
         # turn
-        direction_vector = self._direction_vector
-        # print("\rdirection vector: {}".format(direction_vector[0], direction_vector[1]), end='')
-        ang_velocity_tmp = self.angular_velocity * delta_time * 0.02
-        rotation_matrix = np.array(
-            [[np.cos(np.radians(ang_velocity_tmp)), -np.sin(np.radians(ang_velocity_tmp))],
-             [np.sin(np.radians(ang_velocity_tmp)), np.cos(np.radians(ang_velocity_tmp))]])
-        direction_vector = np.dot(rotation_matrix, direction_vector)
+        cos_value, sin_value = trig_table.get_cos_sin(self.angular_velocity * delta_time * 0.02)
+        rotated_x = cos_value * direction_x - sin_value * direction_y
+        rotated_y = sin_value * direction_x + cos_value * direction_y
         # 方向向量要归一化
-        direction_vector = direction_vector / np.linalg.norm(direction_vector)
-        return self.get_position() + _2d_velocity, direction_vector
+        norm = math.sqrt(rotated_x * rotated_x + rotated_y * rotated_y)
+        return position, np.array([[rotated_x / norm], [rotated_y / norm]])
+
+    def update_motion(self, delta_time):
+        """
+        运行 move 并把得到的位置和方向写回物体，逻辑帧中使用，
+        定点数模式下直接保存新的整数角度，不需要再从方向向量二分查找还原角度
+        :param delta_time:
+        :return:
+        """
+        if self.entity_store is None:
+            self.allocate_entity()
+        if self.entity_store.use_fixed_point:
+            x_fixed, y_fixed, heading = self.get_fixed_point_motion(delta_time)
+            self.set_heading(heading)
+            self.set_position(np.array([[x_fixed / FIXED_ONE], [y_fixed / FIXED_ONE]]))
+        else:
+            pos, direction_vector = self.move(delta_time=delta_time)
+            self.set_direction_vector(direction_vector)
+            self.set_position(pos)
+
+    def move_fixed_point(self, delta_time):
+        """
+        定点数模式的 move：方向为整数角度，三角函数查 Q14 表，位置的变化是整数，
+        只有速度和转向速度是浮点数（只经过加减乘），不依赖任何平台相关的数学库
+        :param delta_time:
+        :return:
+        """
+        x_fixed, y_fixed, heading = self.get_fixed_point_motion(delta_time)
+        direction_x, direction_y = angle_units_to_vector(heading)
+        return (np.array([[x_fixed / FIXED_ONE], [y_fixed / FIXED_ONE]]),
+                np.array([[direction_x], [direction_y]]))
+
+    def get_fixed_point_motion(self, delta_time):
+        """
+        定点数模式下经过 delta_time 之后的 Q14 整数位置和整数角度
+        :param delta_time:
+        :return: (x_fixed, y_fixed, heading)
+        """
+        heading = int(self.entity_store.heading[self.entity_slot])
+        x, y = self.entity_store.position[self.entity_slot].tolist()
+        # ---------------------------------------------
+        # move，位置先转换为 Q14 的整数
+        distance = int(self.velocity * delta_time * 0.1)
+        x_fixed = round(x * FIXED_ONE) + distance * cos_q14(heading)
+        y_fixed = round(y * FIXED_ONE) - distance * sin_q14(heading)
+        # ---------------------------------------------
+        # turn
+        heading = (heading + degrees_to_angle_units(self.angular_velocity * delta_time * 0.02)) & ANGLE_MASK
+        return x_fixed, y_fixed, heading
+
+    def set_heading(self, heading):
+        """
+        定点数模式下设置整数角度，方向向量直接取三角函数表中的值
+        :param heading: 整数角度
+        :return:
+        """
+        heading &= ANGLE_MASK
+        self.entity_store.heading[self.entity_slot] = heading
+        self.entity_store.direction[self.entity_slot] = angle_units_to_vector(heading)
+
+    def get_cos(self, angle):
+        """
+        逻辑运算中使用的 cos，定点数模式下查 Q14 表
+        :param angle: 角度（度）
+        :return:
+        """
+        if self.entity_store is not None and self.entity_store.use_fixed_point:
+            return cos_q14(degrees_to_angle_units(angle)) / FIXED_ONE
+        return trig_table.get_cos(angle)
 
     def get_direction_vector(self):
-        return self._direction_vector
+        return self._direction_vector.copy()
 
     def set_direction_vector(self, vector_2d):
-        vector_2d = vector_2d / np.linalg.norm(vector_2d)
-        self._direction_vector = vector_2d
+        if self.entity_store is not None and self.entity_store.use_fixed_point:
+            self._direction_vector = vector_2d
+            return
+        x, y = np.ravel(vector_2d).tolist()
+        norm = math.sqrt(x * x + y * y)
+        self._direction_vector = (x / norm, y / norm)
 
 
 
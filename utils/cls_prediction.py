@@ -0,0 +1,164 @@
+import numpy as np
+
+from utils.cls_airplane import InputState
+
+
+class PlanePredictor:
+    """
+    本地玩家飞机的预测执行：
+    本地的输入立即作用在预测状态上，不需要等待服务器的同步帧，渲染的时候使用预测状态；
+    权威状态（由同步帧驱动的 fixed_update）前进之后，和同一帧的预测状态进行比较，
+    不一致的时候回滚到权威状态，再用本地记录的输入重新模拟还没有被确认的帧。
+    预测只模拟飞行状态，武器输入会被屏蔽，子弹只由权威状态产生
+    """
+    # 比较预测状态和权威状态时使用的字段，武器冷却和分数会受到开火的影响，不参与比较
+    compare_keys = ('position', 'direction_vector', 'velocity', 'roll_attitude', 'pitch_attitude',
+                    'timer_counter', 'switch_direction', 'engine_temperature', 'heat_counter')
+    weapon_input_mask = InputState.PrimaryWeaponAttack | InputState.SecondaryWeaponAttack
+
+    def __init__(self, max_prediction_frames=15):
+        """
+        :param max_prediction_frames: 预测状态最多领先权威状态的逻辑帧数
+        """
+        self.max_prediction_frames = max_prediction_frames
+        self.plane = None
+        self.confirmed_frame = 0        # 权威状态已经运行到的逻辑帧
+        self.predicted_frame = 0        # 预测状态已经运行到的逻辑帧
+        self.predicted_state = None
+        self.predicted_states = {}      # 还没有确认的每一帧的预测状态
+        self.frame_inputs = {}          # 还没有确认的每一帧使用的本地输入
+        self.input_delay_frames = 0     # 估计的本地输入到出现在权威状态中的逻辑帧数，也就是预测需要领先的帧数
+        self.pending_input = None       # (输入, 输入发生变化时的权威帧)，用于估计 input_delay_frames
+        self.last_input = None
+        self.rollback_count = 0
+        self.resimulated_frames = 0
+
+    def reset(self, plane, authority_frame):
+        """
+        从权威状态重新开始预测，切换飞机或者开始新的一局的时候调用
+        :param plane:
+        :param authority_frame:
+        :return:
+        """
+        self.plane = plane
+        self.confirmed_frame = authority_frame
+        self.predicted_frame = authority_frame
+        self.predicted_state = plane.capture_state() if plane is not None else None
+        self.predicted_states = {}
+        self.frame_inputs = {}
+        self.pending_input = None
+        self.last_input = None
+
+    def is_same_state(self, state_a, state_b):
+        for key in self.compare_keys:
+            if not np.array_equal(state_a[key], state_b[key]):
+                return False
+        return True
+
+    def simulate(self, state, input_state, delta_time):
+        """
+        从 state 出发使用 input_state 运行一个逻辑帧，不会改变飞机当前的权威状态
+        :param state:
+        :param input_state:
+        :param delta_time:
+        :return: 运行之后的状态
+        """
+        authority_state = self.plane.capture_state()
+        self.plane.restore_state(state)
+        self.plane.input_state = input_state
+        self.plane.fixed_update(delta_time=delta_time)
+        next_state = self.plane.capture_state()
+        self.plane.restore_state(authority_state)
+        return next_state
+
+    def confirm(self, authority_frame, delta_time):
+        """
+        权威状态前进到了 authority_frame，丢弃已经确认的预测帧，预测错误的时候回滚并重新模拟
+        :param authority_frame:
+        :param delta_time:
+        :return:
+        """
+        authority_state = self.plane.capture_state()
+        predicted_state = self.predicted_states.get(authority_frame)
+        for frame in [frame for frame in self.predicted_states if frame <= authority_frame]:
+            del self.predicted_states[frame]
+            del self.frame_inputs[frame]
+        self.confirmed_frame = authority_frame
+        if self.predicted_frame <= authority_frame:
+            # 权威状态追上了预测状态，直接从权威状态继续预测
+            self.predicted_frame = authority_frame
+            self.predicted_state = authority_state
+            return
+        if predicted_state is not None and self.is_same_state(predicted_state, authority_state):
+            return
+        self.rollback_count += 1
+        state = authority_state
+        for frame in range(authority_frame + 1, self.predicted_frame + 1):
+            state = self.simulate(state, self.frame_inputs[frame], delta_time)
+            self.predicted_states[frame] = state
+            self.resimulated_frames += 1
+        self.predicted_state = state
+
+    def update_input_delay(self, authority_frame, input_state, authority_input):
+        """
+        本地输入发生变化的时候记录当时的权威帧，等到权威状态使用了这个输入，两者之差就是需要领先的帧数
+        :param authority_frame:
+        :param input_state: 屏蔽了武器之后的本地输入
+        :param authority_input: 权威状态最新使用的本机玩家的输入，None 表示不估计
+        :return:
+        """
+        if authority_input is None:
+            return
+        if input_state != self.last_input:
+            self.last_input = input_state
+            self.pending_input = (input_state, authority_frame)
+        if self.pending_input is not None and (authority_input & ~self.weapon_input_mask) == self.pending_input[0]:
+            self.input_delay_frames = min(authority_frame - self.pending_input[1], self.max_prediction_frames)
+            self.pending_input = None
+
+    def update(self, plane, authority_frame, input_state, delta_time, authority_input=None):
+        """
+        每个本地逻辑帧调用一次，先和权威状态对齐，再用本地输入预测，
+        预测状态领先的帧数不够的时候最多多预测一帧，领先太多的时候这一帧不预测
+        :param plane: 本地玩家控制的飞机
+        :param authority_frame: 权威状态已经运行到的逻辑帧
+        :param input_state: 本地最新的输入状态
+        :param delta_time:
+        :param authority_input: 权威状态最新使用的本机玩家的输入
+        :return:
+        """
+        if plane is None or plane.durability <= 0:
+            self.reset(None, authority_frame)
+            return
+        if plane is not self.plane or authority_frame < self.confirmed_frame:
+            self.reset(plane, authority_frame)
+        elif authority_frame > self.confirmed_frame:
+            self.confirm(authority_frame, delta_time)
+        input_state = input_state & ~self.weapon_input_mask
+        self.update_input_delay(authority_frame, input_state, authority_input)
+        lead_frames = self.predicted_frame - authority_frame
+        predict_frames = 2 if lead_frames < self.input_delay_frames else 1
+        if lead_frames > self.input_delay_frames:
+            predict_frames = 0
+        for _ in range(min(predict_frames, self.max_prediction_frames - lead_frames)):
+            frame = self.predicted_frame + 1
+            self.frame_inputs[frame] = input_state
+            self.predicted_state = self.simulate(self.predicted_state, input_state, delta_time)
+            self.predicted_states[frame] = self.predicted_state
+            self.predicted_frame = frame
+
+    def apply_predicted_state(self, plane):
+        """
+        渲染之前把飞机切换到预测状态
+        :param plane:
+        :return: 飞机的权威状态，渲染之后交给 restore_authority_state
+        """
+        if plane is None or plane is not self.plane or self.predicted_state is None:
+            return None
+        authority_state = plane.capture_state()
+        plane.restore_state(self.predicted_state)
+        return authority_state
+
+    def restore_authority_state(self, plane, authority_state):
+        if authority_state is not None:
+            plane.restore_state(authority_state)
@@ -0,0 +1,192 @@
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from utils.GameProtocolTools import apply_frame_update, decode_frame_update, encode_frame_update, get_changed_actions
+
+'''
+回放文件格式（小端）：
+bytes(magic) + uint8(version) + uint32(header length) + header(utf-8 json)
+header: {"player_id", "fps_physics", "fps_sync", "use_fixed_point", "start_data": cmd_matching_successful 的消息}
+之后是所有的同步帧：[uint32(frame length) + frame_update 的二进制编码] * n
+同步帧和网络协议一样只记录发生变化的玩家操作，每隔 keyframe_interval 帧记录一次包含所有玩家操作的关键帧
+'''
+REPLAY_MAGIC = b'FARP'
+REPLAY_VERSION = 1
+replay_header_format = '<4sBI'
+replay_frame_format = '<I'
+
+replay_header_length = struct.calcsize(replay_header_format)
+replay_frame_length = struct.calcsize(replay_frame_format)
+
+
+class ReplayRecorder:
+    """
+    把一局游戏的开局信息和所有同步帧的玩家操作写入回放文件，同步帧写入文件之后不再保存在内存中
+    """
+    def __init__(self, keyframe_interval=150):
+        """
+        :param keyframe_interval: 每隔多少个同步帧记录一次关键帧
+        """
+        self.keyframe_interval = keyframe_interval
+        self.file = None
+        self.file_path = None
+        self.last_actions = {}          # 上一个同步帧的完整操作
+        self.frame_count = 0
+
+    def start(self, file_path, header):
+        """
+        开始记录新的一局，之前没有关闭的回放会先关闭
+        :param file_path:
+        :param header: 开局信息，必须可以编码为 json
+        :return:
+        """
+        self.close()
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        header_data = json.dumps(header).encode()
+        self.file = open(file_path, 'wb')
+        self.file.write(struct.pack(replay_header_format, REPLAY_MAGIC, REPLAY_VERSION, len(header_data)))
+        self.file.write(header_data)
+        self.file_path = file_path
+        self.last_actions = {}
+        self.frame_count = 0
+
+    def record_frame(self, frame):
+        """
+        记录一个同步帧
+        :param frame: 还原之后包含所有玩家完整操作的 frame_update
+        :return:
+        """
+        if self.file is None:
+            return
+        is_keyframe = self.frame_count % self.keyframe_interval == 0
+        actions = frame['actions'] if is_keyframe else get_changed_actions(self.last_actions, frame['actions'])
+        data = encode_frame_update({'sync_time_stamp': frame['sync_time_stamp'],
+                                    'is_keyframe': is_keyframe,
+                                    'actions': actions})
+        self.file.write(struct.pack(replay_frame_format, len(data)))
+        self.file.write(data)
+        self.last_actions = dict(frame['actions'])
+        self.frame_count += 1
+
+    def close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        print('replay saved: {}, {} sync frames.'.format(self.file_path, self.frame_count))
+        self.file = None
+
+
+class ReplayReader:
+    """
+    读取回放文件，还原每一个同步帧的完整操作
+    """
+    def __init__(self, file_path):
+        with open(file_path, 'rb') as file:
+            data = file.read()
+        magic, version, header_length = struct.unpack_from(replay_header_format, data, 0)
+        if magic != REPLAY_MAGIC:
+            raise ValueError('not a replay file: {}'.format(file_path))
+        if version != REPLAY_VERSION:
+            raise ValueError('unsupported replay version: {}'.format(version))
+        offset = replay_header_length
+        self.header = json.loads(data[offset:offset + header_length].decode())
+        offset += header_length
+        self.frames = []
+        full_actions = {}
+        while offset + replay_frame_length <= len(data):
+            frame_length = struct.unpack_from(replay_frame_format, data, offset)[0]
+            offset += replay_frame_length
+            if offset + frame_length > len(data):
+                # 游戏异常退出的时候最后一帧可能没有写完整
+                break
+            frame = decode_frame_update(data[offset:offset + frame_length])
+            frame['actions'] = dict(apply_frame_update(full_actions, frame))
+            self.frames.append(frame)
+            offset += frame_length
+
+    def __len__(self):
+        return len(self.frames)
+
+
+class ReplayPlayer:
+    """
+    无渲染的回放播放器：按照回放中的同步帧，用最快的速度重新运行游戏的逻辑帧，
+    每一个同步帧的操作和正常游戏时一样作用到 sync_time_stamp * frame_step 为止的所有逻辑帧上
+    """
+    def __init__(self, game, reader):
+        """
+        :param game: FightingAircraftGame，需要已经设置好 genetic_manager
+        :param reader: ReplayReader
+        """
+        self.game = game
+        # 回放的时候不需要再记录新的回放文件
+        self.game.use_replay_recorder = False
+        self.reader = reader
+        self.frame_step = reader.header['fps_physics'] / reader.header['fps_sync']
+        self.delta_time = np.round(1000 / reader.header['fps_physics'], decimals=2)
+        self.frame_index = 0            # 下一个要运行的同步帧
+        self.state_hashes = {}          # 运行过程中的状态哈希 {逻辑帧: 哈希}，和服务器报告的不同步的逻辑帧对照
+
+    def restart(self):
+        """
+        按照回放的开局信息重新开始
+        :return:
+        """
+        header = self.reader.header
+        self.game.player_id = header['player_id']
+        self.game.game_data.set_fixed_point(header.get('use_fixed_point', False))
+        self.game.create_new_game(header['start_data'])
+        self.frame_index = 0
+        self.state_hashes = {}
+
+    def step(self):
+        """
+        运行一个同步帧
+        :return: 是否还有没有运行的同步帧
+        """
+        if self.frame_index >= len(self.reader.frames):
+            return False
+        frame = self.reader.frames[self.frame_index]
+        while self.game.local_physic_time_stamp <= frame['sync_time_stamp'] * self.frame_step:
+            self.game.run_physic_frame(frame['actions'], self.delta_time)
+        # 回放的时候状态哈希不需要发送
+        self.state_hashes.update(self.game.pending_state_hashes)
+        self.game.pending_state_hashes.clear()
+        self.frame_index += 1
+        return self.frame_index < len(self.reader.frames)
+
+    def seek(self, frame_index):
+        """
+        跳转到第 frame_index 个同步帧之前，向后跳转的时候需要从头重新运行
+        :param frame_index:
+        :return:
+        """
+        if frame_index < self.frame_index:
+            self.restart()
+        while self.frame_index < frame_index and self.step():
+            pass
+
+    def run(self, max_frames=None):
+        """
+        用最快的速度运行剩下的同步帧
+        :param max_frames: 最多运行的同步帧数量，None 表示运行到最后
+        :return: 运行的统计信息
+        """
+        start_time = time.perf_counter()
+        start_physic_frame = self.game.local_physic_time_stamp
+        frame_count = 0
+        while self.frame_index < len(self.reader.frames) and (max_frames is None or frame_count < max_frames):
+            self.step()
+            frame_count += 1
+        elapsed = time.perf_counter() - start_time
+        physic_frames = self.game.local_physic_time_stamp - start_physic_frame
+        return {'sync_frames': frame_count,
+                'physic_frames': physic_frames,
+                'elapsed': elapsed,
+                'speed': physic_frames / self.reader.header['fps_physics'] / elapsed if elapsed > 0 else 0.}
@@ -0,0 +1,130 @@
+import pygame
+
+
+def get_wrapped_cells(start, end, size, cell_size):
+    """
+    获取循环地图上区间 [start, end) 覆盖的所有格子的下标
+    :param start:
+    :param end:
+    :param size: 地图在这个方向上的大小
+    :param cell_size: 格子的大小
+    :return:
+    """
+    cell_count = int((size + cell_size - 1) // cell_size)
+    if end - start >= size:
+        return range(cell_count)
+    length = end - start
+    start = start % size
+    end = start + length
+    if end <= size:
+        return range(int(start // cell_size), int((max(end, start + 1) - 1) // cell_size) + 1)
+    return (list(range(int(start // cell_size), cell_count)) +
+            list(range(0, int((end - size - 1) // cell_size) + 1)))
+
+
+def is_wrapped_overlap(start_a, length_a, start_b, length_b, size):
+    """
+    判断循环地图上的两个区间是否相交
+    """
+    if length_a <= 0 or length_b <= 0:
+        return False
+    return (start_b - start_a) % size < length_a or (start_a - start_b) % size < length_b
+
+
+def get_wrapped_offset(offset, size):
+    """
+    循环地图上两个位置的最短偏移
+    """
+    offset = offset % size
+    if offset > size / 2:
+        offset -= size
+    return int(offset)
+
+
+def collide_mask_wrapped(left, right, map_size):
+    """
+    和 pygame.sprite.collide_mask 相同，但是考虑了地图的循环，跨越地图边界的两个物体也可以正确的检测
+    :param left:
+    :param right:
+    :param map_size:
+    :return: 第一个相交的点，不相交的时候为 None
+    """
+    x_offset = get_wrapped_offset(right.rect[0] - left.rect[0], map_size[0])
+    y_offset = get_wrapped_offset(right.rect[1] - left.rect[1], map_size[1])
+    left_mask = left.mask if left.mask is not None else pygame.mask.from_surface(left.image)
+    right_mask = right.mask if right.mask is not None else pygame.mask.from_surface(right.image)
+    return left_mask.overlap(right_mask, (x_offset, y_offset))
+
+
+class SpatialHash:
+    """
+    循环地图上的均匀网格，用于子弹碰撞检测的粗筛：
+    每个物理帧开始的时候把碰撞分组中的物体按照 rect 放入覆盖的格子，
+    子弹只和附近格子中的物体比较 rect，不再和整个分组比较
+    """
+    def __init__(self, cell_size=128, margin=32):
+        """
+        :param cell_size: 格子的大小（像素）
+        :param margin: 查询时 rect 向外扩展的距离，物体在重建之后的同一帧中还会移动，需要覆盖这一帧的移动距离
+        """
+        self.cell_size = cell_size
+        self.margin = margin
+        self.map_size = (1, 1)
+        self.cells = {}                 # {(cell_x, cell_y): [物体在分组中的顺序, ...]}
+        self.sprites = []               # 按照分组中的顺序保存的物体
+        self.collision_group = None
+
+    def rebuild(self, collision_group, map_size):
+        """
+        根据碰撞分组中物体当前的 rect 重建网格
+        :param collision_group: pygame.sprite.Group
+        :param map_size:
+        :return:
+        """
+        self.map_size = (int(map_size[0]), int(map_size[1]))
+        self.collision_group = collision_group
+        self.cells = {}
+        self.sprites = collision_group.sprites()
+        for index, sprite in enumerate(self.sprites):
+            rect = sprite.rect
+            for cell in self.get_rect_cells(rect.x, rect.y, rect.width, rect.height):
+                self.cells.setdefault(cell, []).append(index)
+
+    def get_rect_cells(self, x, y, width, height):
+        cells_x = get_wrapped_cells(x, x + max(width, 1), self.map_size[0], self.cell_size)
+        cells_y = get_wrapped_cells(y, y + max(height, 1), self.map_size[1], self.cell_size)
+        return [(cell_x, cell_y) for cell_x in cells_x for cell_y in cells_y]
+
+    def query(self, rect):
+        """
+        获取和 rect 相交的物体，结果按照物体在分组中的顺序排列，和 pygame.sprite.spritecollide 一致
+        :param rect:
+        :return:
+        """
+        indices = set()
+        for cell in self.get_rect_cells(rect.x - self.margin, rect.y - self.margin,
+                                        rect.width + 2 * self.margin, rect.height + 2 * self.margin):
+            indices.update(self.cells.get(cell, ()))
+        result = []
+        for index in sorted(indices):
+            sprite = self.sprites[index]
+            # 重建之后被移出分组的物体（例如这一帧中被击毁的飞机）不再参与检测
+            if not self.collision_group.has(sprite):
+                continue
+            if (is_wrapped_overlap(rect.x, rect.width, sprite.rect.x, sprite.rect.width, self.map_size[0]) and
+                    is_wrapped_overlap(rect.y, rect.height, sprite.rect.y, sprite.rect.height, self.map_size[1])):
+                result.append(sprite)
+        return result
+
+    def collide_group(self, bullet_group):
+        """
+        和 pygame.sprite.groupcollide(bullet_group, collision_group, False, False) 返回相同格式的结果
+        :param bullet_group:
+        :return: {bullet: [target, ...]}
+        """
+        crashed = {}
+        for bullet in bullet_group:
+            targets = self.query(bullet.rect)
+            if targets:
+                crashed[bullet] = targets
+        return crashed
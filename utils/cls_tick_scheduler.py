@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import time
+
+
+class TickScheduler:
+    """
+    服务器帧同步的调度器，每个房间单独维护一个单调递增的截止时间，
+    截止时间按照 start_time + tick_index * period 计算，不会因为每一帧的处理耗时累积误差，
+    所有房间的截止时间放在同一个最小堆里面，只使用 time.monotonic，不依赖 pygame
+    """
+    def __init__(self, tick_rate=10, max_catch_up_ticks=3, late_tolerance=0.5):
+        """
+        :param tick_rate: 每秒的帧数
+        :param max_catch_up_ticks: 房间落后的时候一次最多补发的帧数，落后更多的帧会被跳过
+        :param late_tolerance: 超过截止时间多少个周期算作错过了截止时间
+        """
+        self.tick_rate = tick_rate
+        self.period = 1.0 / tick_rate
+        self.max_catch_up_ticks = max_catch_up_ticks
+        self.late_tolerance = late_tolerance * self.period
+        self.deadline_heap = []             # (deadline, sequence, room_key)
+        self.sequence = itertools.count()   # 截止时间相同的时候保证堆中的元素可以比较
+        self.room_2_schedule = {}
+        self.missed_deadlines = 0           # 错过截止时间的次数
+        self.skipped_ticks = 0              # 落后太多被跳过的帧数
+        self.max_lateness = 0.              # 最大的延迟时间，单位秒
+
+    def get_deadline(self, schedule):
+        return schedule['start_time'] + schedule['tick_index'] * self.period
+
+    def push_deadline(self, room_key, schedule):
+        heapq.heappush(self.deadline_heap, (self.get_deadline(schedule), next(self.sequence), room_key))
+
+    def add_room(self, room_key, now=None):
+        """
+        添加房间，第一帧在一个周期之后执行
+        :param room_key: 房间号
+        :param now: 当前时间，默认为 time.monotonic()
+        :return:
+        """
+        if now is None:
+            now = time.monotonic()
+        schedule = {'start_time': now + self.period,
+                    'tick_index': 0,
+                    'missed_deadlines': 0,
+                    'max_lateness': 0.}
+        self.room_2_schedule[room_key] = schedule
+        self.push_deadline(room_key, schedule)
+
+    def remove_room(self, room_key):
+        """
+        删除房间，堆中剩余的截止时间在出堆的时候丢弃
+        :param room_key:
+        :return:
+        """
+        self.room_2_schedule.pop(room_key, None)
+
+    def pop_due_rooms(self, now=None):
+        """
+        取出所有已经到达截止时间的房间
+        :param now: 当前时间，默认为 time.monotonic()
+        :return: [(room_key, tick_count), ...]，tick_count 为这个房间本次需要执行的帧数
+        """
+        if now is None:
+            now = time.monotonic()
+        due_rooms = []
+        while self.deadline_heap and self.deadline_heap[0][0] <= now:
+            deadline, _, room_key = heapq.heappop(self.deadline_heap)
+            schedule = self.room_2_schedule.get(room_key)
+            if schedule is None or deadline != self.get_deadline(schedule):
+                # 房间已经被删除了
+                continue
+            lateness = now - deadline
+            due_ticks = int(lateness / self.period) + 1
+            tick_count = min(due_ticks, self.max_catch_up_ticks)
+            if lateness > self.late_tolerance:
+                schedule['missed_deadlines'] += 1
+                self.missed_deadlines += 1
+            schedule['max_lateness'] = max(schedule['max_lateness'], lateness)
+            self.max_lateness = max(self.max_lateness, lateness)
+            self.skipped_ticks += due_ticks - tick_count
+            # 跳过的帧也计入 tick_index，保证之后的截止时间仍然和墙上时间对齐
+            schedule['tick_index'] += due_ticks
+            self.push_deadline(room_key, schedule)
+            due_rooms.append((room_key, tick_count))
+        return due_rooms
+
+    def get_wait_time(self, now=None):
+        """
+        距离下一个截止时间的时间，最长不超过一个周期，保证新加入的房间不会错过第一帧
+        :param now:
+        :return: 单位秒
+        """
+        if not self.deadline_heap:
+            return self.period
+        if now is None:
+            now = time.monotonic()
+        return max(0., min(self.deadline_heap[0][0] - now, self.period))
+
+    def report(self, reset=True):
+        """
+        获取错过截止时间的统计信息
+        :param reset: 获取之后是否清零
+        :return:
+        """
+        result = {'rooms': len(self.room_2_schedule),
+                  'missed_deadlines': self.missed_deadlines,
+                  'skipped_ticks': self.skipped_ticks,
+                  'max_lateness_ms': self.max_lateness * 1000}
+        if reset:
+            self.missed_deadlines = 0
+            self.skipped_ticks = 0
+            self.max_lateness = 0.
+        return result